@@ -3,11 +3,12 @@
 	CLI for the MDL processor.
 """
 from typing import *
-import argparse, os, sys, codecs
+import argparse, os, sys, codecs, tempfile
 from importlib import resources
 
 from mdl import  format_html, format_markdown, render, structure, ParseException, format_mdl
 from .document import load_document
+from .doc_cache import DocumentCache
 
 class Output(NamedTuple):
 	filename: str
@@ -33,6 +34,25 @@ def list_formats() -> None:
 		print(f'{ref}: {format["name"]}')
 		
 	
+def write_output( filename : str, write : Callable[[TextIO], None] ) -> None:
+	"""
+		Writes to a temporary file, replacing the output only once complete, thus a failure
+		leaves any previous output intact.
+	"""
+	fd, temp_path = tempfile.mkstemp( dir = os.path.dirname( os.path.abspath( filename ) ), suffix = '.tmp' )
+	try:
+		# Given the permissions `open` would, rather than the private ones of a temporary file
+		umask = os.umask( 0 )
+		os.umask( umask )
+		os.chmod( temp_path, 0o666 & ~umask )
+		with os.fdopen( fd, 'w', encoding = 'utf-8' ) as out_file:
+			write( out_file )
+		os.replace( temp_path, filename )
+	except BaseException:
+		os.remove( temp_path )
+		raise
+		
+		
 def main() -> None:
 	cli_args = argparse.ArgumentParser( description = 'Process an MDL document' )
 
@@ -41,6 +61,9 @@ def main() -> None:
 		metavar=('format', 'filename'),
 		help='Write using format to filename' )
 	cli_args.add_argument( '--list-formats', action='store_true', help='List the available formats' )
+	cli_args.add_argument( '--cache-dir', metavar='directory', 
+		help='Reuse documents loaded by earlier runs from this directory. Entries are pickled, '
+			'so only use a directory no untrusted user can write to' )
 
 	debug = cli_args.add_argument_group( title='Maintainer Debugging Tools' )
 	debug.add_argument( '--dump-parse', action='store_true', help='Dump the parse tree' )
@@ -72,6 +95,7 @@ def main() -> None:
 		print( f'Loading MDL {mdl_file}' )
 		try:
 			doc = load_document( mdl_file, 
+				cache = DocumentCache( args.cache_dir ) if args.cache_dir else None,
 				_dump_parse = args.dump_parse,
 				_write_parse = args.write_parse[0] if args.write_parse else None,
 				_write_doc = args.write_doc[0] if args.write_doc else None,
@@ -86,9 +110,7 @@ def main() -> None:
 		for output in outputs:
 			print( f'Writing {output.format["name"]} to {output.filename}' )
 			writer = writerMap[output.format['render']](**output.format.get('args',{}))
-			text = writer.render( doc )
-			with open( output.filename, 'w', encoding = 'utf-8' ) as out_file:
-				out_file.write( text )
+			write_output( output.filename, lambda out_file: writer.render_to( doc, out_file ) )
 
 			
 main()
@@ -0,0 +1,116 @@
+# Memoized parses of top-level blocks
+from __future__ import annotations # type: ignore
+__all__ = [ 'BlockMemo' ]
+
+from typing import *
+from collections import OrderedDict
+import hashlib, pickle
+
+from .source import Source
+from .parse_tree import Node, Annotation
+
+# The blocks parsed from a run of text, and the annotations left after them, at offset 0
+_Entry = Tuple[List[Node], List[Annotation]]
+
+
+"""
+	Parsed top-level blocks, keyed by a hash of the text they were parsed from. Recently used
+	entries are kept in memory, up to `max_entries`. If a `store` is provided, such as one
+	opened with `dbm`, entries are also written to it, and read from it on a miss in memory.
+
+	Entries are copied in and out, so a tree built from the memo may be modified freely.
+"""
+class BlockMemo:
+	def __init__( self, *, max_entries : int = 4096, store : Optional[MutableMapping[str, bytes]] = None ):
+		self._entries : OrderedDict[str, _Entry] = OrderedDict()
+		self._max_entries = max_entries
+		self._store = store
+		self._detached = Source.with_text( '' )
+
+		self._hits = 0
+		self._store_hits = 0
+		self._misses = 0
+
+	@property
+	def hits( self ) -> int:
+		"""
+			Lookups found in memory or in the store
+		"""
+		return self._hits
+
+	@property
+	def store_hits( self ) -> int:
+		"""
+			Those of the hits found in the store
+		"""
+		return self._store_hits
+
+	@property
+	def misses( self ) -> int:
+		return self._misses
+
+	def __len__( self ) -> int:
+		return len(self._entries)
+
+	def get_key( self, grammar_fingerprint : bytes, indent : str, text : str, *, max_depth : int ) -> str:
+		"""
+			@param max_depth That of the parser, as a parse within one limit may fail with another
+		"""
+		digest = hashlib.sha256( grammar_fingerprint )
+		digest.update( f'{max_depth}\0'.encode( 'utf-8' ) )
+		digest.update( indent.encode( 'utf-8' ) + b'\0' )
+		digest.update( text.encode( 'utf-8' ) )
+		return digest.hexdigest()
+
+	def get( self, key : str, source : Source, offset : int ) -> Optional[_Entry]:
+		"""
+			@return copies of the blocks and annotations, moved to `offset` in `source`
+		"""
+		entry = self._entries.get( key )
+		if entry is not None:
+			self._entries.move_to_end( key )
+		elif self._store is not None:
+			entry = self._load( key )
+			if entry is not None:
+				self._store_hits += 1
+				self._add( key, entry )
+
+		if entry is None:
+			self._misses += 1
+			return None
+
+		self._hits += 1
+		blocks, annotations = entry
+		return [ block.copy( source, offset ) for block in blocks ], [ anno.copy( source, offset ) for anno in annotations ]
+
+	def put( self, key : str, blocks : Sequence[Node], annotations : Sequence[Annotation], offset : int ) -> None:
+		"""
+			@param offset Where the text the blocks were parsed from starts
+		"""
+		entry = (
+			[ block.copy( self._detached, -offset ) for block in blocks ],
+			[ anno.copy( self._detached, -offset ) for anno in annotations ],
+		)
+		self._add( key, entry )
+
+		if self._store is not None:
+			try:
+				self._store[key] = pickle.dumps( entry, protocol = pickle.HIGHEST_PROTOCOL )
+			except RecursionError:
+				pass
+
+	def _add( self, key : str, entry : _Entry ) -> None:
+		self._entries[key] = entry
+		if len(self._entries) > self._max_entries:
+			self._entries.popitem( last = False )
+
+	def _load( self, key : str ) -> Optional[_Entry]:
+		assert self._store is not None
+		data = self._store.get( key )
+		if data is None:
+			return None
+		try:
+			return cast(_Entry, pickle.loads( data ))
+		except Exception:
+			# A damaged entry is a miss, and is replaced once the text is parsed again
+			return None
@@ -0,0 +1,191 @@
+# On-disk cache of loaded documents
+from __future__ import annotations # type: ignore
+__all__ = [ 'DocumentCache', 'get_code_fingerprint' ]
+
+from typing import *
+import hashlib, io, os, pickle, tempfile, zlib
+
+from . import doc_tree
+
+if TYPE_CHECKING:
+	from .document import Document
+
+# Changed whenever the stored form changes in a way the code fingerprint doesn't capture
+_format_version = b'1'
+
+_code_fingerprint : Optional[bytes] = None
+
+def get_code_fingerprint() -> bytes:
+	"""
+		A hash of the source of this package, thus any change to the parser, the grammar, or the
+		document conversion changes it. Used in the keys of caches kept across processes.
+	"""
+	global _code_fingerprint
+	if _code_fingerprint is None:
+		digest = hashlib.sha256( _format_version )
+		package_dir = os.path.dirname( os.path.abspath( __file__ ) )
+		for name in sorted( os.listdir( package_dir ) ):
+			if name.endswith( '.py' ):
+				with open( os.path.join( package_dir, name ), 'rb' ) as in_file:
+					digest.update( name.encode( 'utf-8' ) )
+					digest.update( in_file.read() )
+		_code_fingerprint = digest.digest()
+	return _code_fingerprint
+
+
+def _get_shared_objects() -> Dict[str, object]:
+	"""
+		Instances shared by all documents, such as `doc_tree.block_quote`. They are compared by
+		identity, so they're stored by name, and restored as the same instance.
+	"""
+	return {
+		name: value for name, value in vars(doc_tree).items()
+		if isinstance( value, ( doc_tree.BlockClass, doc_tree.InlineFeature ) )
+	}
+
+
+class _Pickler(pickle.Pickler):
+	def __init__( self, file : IO[bytes], shared_names : Dict[int, str] ):
+		super().__init__( file, protocol = pickle.HIGHEST_PROTOCOL )
+		self._shared_names = shared_names
+
+	def persistent_id( self, obj : Any ) -> Optional[str]:
+		return self._shared_names.get( id(obj) )
+
+
+class _Unpickler(pickle.Unpickler):
+	def __init__( self, file : IO[bytes], shared : Dict[str, object] ):
+		super().__init__( file )
+		self._shared = shared
+
+	def persistent_load( self, pid : Any ) -> object:
+		return self._shared[pid]
+
+
+"""
+	A directory of loaded documents, keyed by a hash of the source file bytes and of the code
+	that loads them. Entries are pickled and compressed. The total size is bounded, with the
+	least recently used entries evicted first, the use being tracked by file modification time.
+	The total is counted once, then kept up to date as entries are added, and the directory is
+	only scanned again when the total exceeds the bound, evicting entries to well below it.
+	Entries added by other processes are thus only counted at that scan.
+
+	Entries are written to a temporary file and moved into place, thus a reader never sees a
+	partial entry. An entry which fails to load is treated as a miss and removed.
+	
+	Loading an entry unpickles it, which can run arbitrary code. The directory must only be
+	writable by those trusted to run code as the user loading documents.
+"""
+class DocumentCache:
+	def __init__( self, path : str, *, max_bytes : int = 256 << 20 ):
+		self._path = path
+		self._max_bytes = max_bytes
+		self._shared = _get_shared_objects()
+		self._shared_names = { id(value): name for name, value in self._shared.items() }
+		# The total size of the entries, counted on the first `put`
+		self._total_bytes : Optional[int] = None
+		os.makedirs( path, exist_ok = True )
+
+	@property
+	def path( self ) -> str:
+		return self._path
+
+	def get_key( self, data : bytes ) -> str:
+		"""
+			@param data The bytes of the source file
+		"""
+		digest = hashlib.sha256( get_code_fingerprint() )
+		digest.update( data )
+		return digest.hexdigest()
+
+	def get( self, key : str ) -> Optional[Document]:
+		entry_path = self._entry_path( key )
+		try:
+			with open( entry_path, 'rb' ) as in_file:
+				data = in_file.read()
+		except FileNotFoundError:
+			return None
+
+		try:
+			doc = _Unpickler( io.BytesIO( zlib.decompress( data ) ), self._shared ).load()
+		except Exception:
+			self._remove( entry_path )
+			return None
+
+		# Mark the entry as recently used
+		try:
+			os.utime( entry_path )
+		except OSError:
+			pass
+		return cast('Document', doc)
+
+	def put( self, key : str, doc : Document ) -> None:
+		buffer = io.BytesIO()
+		try:
+			_Pickler( buffer, self._shared_names ).dump( doc )
+		except ( pickle.PicklingError, TypeError, AttributeError, RecursionError ):
+			# The document is still usable, it just isn't cached
+			return
+		data = zlib.compress( buffer.getvalue() )
+
+		if self._total_bytes is None:
+			self._total_bytes = self._scan()[1]
+			
+		entry_path = self._entry_path( key )
+		try:
+			replaced = os.stat( entry_path ).st_size
+		except OSError:
+			replaced = 0
+			
+		fd, temp_path = tempfile.mkstemp( dir = self._path, suffix = '.tmp' )
+		try:
+			with os.fdopen( fd, 'wb' ) as out_file:
+				out_file.write( data )
+			os.replace( temp_path, entry_path )
+		except BaseException:
+			self._remove( temp_path )
+			raise
+
+		self._total_bytes += len(data) - replaced
+		if self._total_bytes > self._max_bytes:
+			self._evict()
+
+	def _entry_path( self, key : str ) -> str:
+		return os.path.join( self._path, key + '.doc' )
+
+	def _scan( self ) -> Tuple[List[Tuple[float, int, str]], int]:
+		"""
+			@return the entries, as modification time, size and path, and their total size
+		"""
+		entries = []
+		total = 0
+		with os.scandir( self._path ) as scan:
+			for entry in scan:
+				if not entry.name.endswith( '.doc' ):
+					continue
+				try:
+					stat = entry.stat()
+				except FileNotFoundError:
+					continue
+				entries.append( ( stat.st_mtime, stat.st_size, entry.path ) )
+				total += stat.st_size
+
+		return entries, total
+		
+	def _evict( self ) -> None:
+		# Evicting below the bound leaves room for many entries before the next scan
+		target = self._max_bytes * 3 // 4
+		entries, total = self._scan()
+		entries.sort()
+		for _, size, entry_path in entries:
+			if total <= target:
+				break
+			self._remove( entry_path )
+			total -= size
+		self._total_bytes = total
+
+	def _remove( self, entry_path : str ) -> None:
+		try:
+			os.remove( entry_path )
+		except OSError:
+			pass
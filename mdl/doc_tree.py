@@ -5,8 +5,9 @@
 """
 from __future__ import annotations # type: ignore
 
-import typing, abc
+import typing, abc, heapq
 from enum import Enum
+from . import validation
 
 		
 class VisitCallback(typing.Protocol):
@@ -20,54 +21,245 @@ class VisitCallback(typing.Protocol):
 		
 		
 class TransformType(Enum):
+	# The node is kept
 	retain = 1
+	# The node is replaced by the one given
 	replace = 2
+	# The node is removed
 	delete = 3
+	# The nodes given are inserted before the node, which is kept
+	insert = 4
+	# The node is replaced by the nodes given, which may be none
+	splice = 5
 
+"""
+	The nodes resulting from `transform` are transformed in turn: entered, their children
+	transformed, and exited.
+"""
 class TransformCallback(VisitCallback):
 	@abc.abstractmethod
-	def transform(self, node: Node ) -> tuple[TransformType, Node]:
+	def transform(self, node: Node ) -> tuple[TransformType, Node | typing.Sequence[Node]]:
+		"""
+			@return the type, and the node for `replace`, or the nodes for `insert` and `splice`.
+				It's ignored otherwise.
+		"""
 		...
 	
+	
+class WalkEvent(Enum):
+	enter = 1
+	exit = 2
+	
+	
+"""
+	Yields an `enter` event for each node of the tree, in document order, and an `exit` event
+	once its children have been walked. The nodes are kept on a stack, rather than walked
+	recursively, thus a tree of any depth may be walked.
+	
+	The children of a node are walked as they are when it's entered. Changing them while the
+	node's children are being walked is unsupported.
+	
+	@param types If provided, only events for nodes of these types are yielded, though the
+		children of other nodes are still walked
+	@param prune If provided, called as each node is entered. The children of the nodes for
+		which it returns True aren't walked.
+"""
+def walk( node : Node, *, 
+	types : type | tuple[type, ...] | None = None,
+	prune : typing.Callable[[Node], bool] | None = None,
+) -> typing.Iterator[tuple[WalkEvent, Node]]:
+	# Each entry is a node, its children, and the index of the next child to walk
+	stack : list[list[typing.Any]] = []
+	next_node : Node | None = node
+	while True:
+		if next_node is not None:
+			if types is None or isinstance( next_node, types ):
+				yield WalkEvent.enter, next_node
+			children = _no_children if prune is not None and prune( next_node ) else next_node.iter_children()
+			stack.append( [ next_node, children, 0 ] )
+			next_node = None
+			
+		frame = stack[-1]
+		children = frame[1]
+		if frame[2] < len(children):
+			next_node = children[frame[2]]
+			frame[2] += 1
+			continue
+			
+		_ = stack.pop()
+		if types is None or isinstance( frame[0], types ):
+			yield WalkEvent.exit, frame[0]
+		if len(stack) == 0:
+			return
+	
+	
+_no_children : typing.Sequence[typing.Any] = ()
+	
 
+"""
+	Nodes have `__slots__`, and containers share an empty child sequence until a child is
+	added, as a document may have a great many nodes.
+"""
 class Node(abc.ABC):
+	__slots__ = ()
+	
+	# Only block nodes may have comments, other nodes have none
+	comment: typing.Collection[Node] | None = None
+	
 	def __init__(self):
 		super().__init__()
-		self.comment: typing.Collection[Node] | None = None
+		
+	def iter_children( self ) -> typing.Sequence[Node]:
+		"""
+			The nodes visited, and walked, within this one
+		"""
+		return _no_children
 		
 	def visit( self, proc : VisitCallback ) -> None:
-		if proc.enter( self ):
-			self.visit_children( proc )
-		proc.exit( self )
+		# The callback decides whether to enter each node's children as it's entered
+		for event, node in walk( self, prune = lambda entered: not proc.enter( entered ) ):
+			if event is WalkEvent.exit:
+				proc.exit( node )
 		
 	def visit_children( self, proc : VisitCallback ) -> None:
-		pass
+		for node in self.iter_children():
+			node.visit( proc )
 		
 	def transform( self, proc: TransformCallback ) -> None:
 		if proc.enter( self ):
-			self.transform_children( proc )
-		proc.exit( self )
+			_transform_walk( [ _TransformFrame( self ) ], proc )
+		else:
+			proc.exit( self )
 
 	def transform_children( self, proc : TransformCallback ) -> None:
-		pass
+		_transform_walk( [ _TransformFrame( self ) ], proc, exit_root = False )
+		
+		
+"""
+	A node being transformed. Its new children are built as its children are transformed,
+	and replace them once all have been.
+"""
+class _TransformFrame:
+	__slots__ = ( 'node', 'subs', 'at', 'new_subs', 'descend', 'descend_at' )
+	
+	def __init__( self, node : Node ):
+		self.node = node
+		container : typing.Any = node
+		self.subs : typing.Sequence[Node] = container._sub if isinstance( container, NodeContainer ) else _no_children
+		self.at = 0
+		# The new children, from the first change onward, else they're the same as `subs`
+		self.new_subs : list[Node] | None = None
+		# The nodes resulting from transforming the last child, to be transformed in turn
+		self.descend : typing.Sequence[Node] = _no_children
+		self.descend_at = 0
+		
+		
+"""
+	Transforms the children of the nodes on the stack, and then their children, keeping the
+	nodes entered on the stack rather than recursing. The children of each node are replaced
+	once in total, thus the time taken is linear in the number of nodes, however many are
+	inserted or deleted.
+	
+	@param exit_root Whether `exit` is called for the node at the bottom of the stack
+"""
+def _transform_walk( stack : list[_TransformFrame], proc : TransformCallback, *, exit_root : bool = True ) -> None:
+	while len(stack) > 0:
+		frame = stack[-1]
+		if frame.descend_at < len(frame.descend):
+			node = frame.descend[frame.descend_at]
+			frame.descend_at += 1
+			if proc.enter( node ):
+				stack.append( _TransformFrame( node ) )
+			else:
+				proc.exit( node )
+			continue
+			
+		if frame.at >= len(frame.subs):
+			if frame.new_subs is not None:
+				frame.node._sub_changed() # type: ignore[attr-defined]
+				# We have no way to verify the types match the container
+				frame.node._sub = frame.new_subs if len(frame.new_subs) > 0 else _empty # type: ignore[attr-defined]
+			_ = stack.pop()
+			if exit_root or len(stack) > 0:
+				proc.exit( frame.node )
+			continue
+			
+		node = frame.subs[frame.at]
+		trans_type, result = proc.transform( node )
+		results : typing.Sequence[Node]
+		match trans_type:
+			case TransformType.retain:
+				results = ( node, )
+			case TransformType.replace:
+				assert isinstance( result, Node )
+				results = ( result, )
+			case TransformType.delete:
+				results = _no_children
+			case TransformType.insert:
+				assert not isinstance( result, Node )
+				results = ( *result, node )
+			case TransformType.splice:
+				assert not isinstance( result, Node )
+				results = result
+				
+		if frame.new_subs is None and ( len(results) != 1 or results[0] is not node ):
+			frame.new_subs = list( frame.subs[:frame.at] )
+		if frame.new_subs is not None:
+			frame.new_subs.extend( results )
+			
+		frame.at += 1
+		frame.descend = results
+		frame.descend_at = 0
 
 		
+# The children of a container to which none have been added
+_empty : typing.Sequence[typing.Any] = ()
+
+"""
+	The `_sub` and `_indexed_by` slots are declared by the concrete containers, as they also
+	derive from a `Node` with slots of its own.
+"""
 class NodeContainer[T: Node]:
+	__slots__ = ()
+	_sub : typing.List[T]
+	
 	def __init__(self):
 		super().__init__()
-		self._sub : typing.List[T] = []
+		self._sub = _empty # type: ignore[assignment,misc]
+		# The root whose index includes this container, which is outdated if it changes
+		self._indexed_by : RootSection | None = None # type: ignore[misc]
+
+	def _sub_changed( self ) -> None:
+		if self._indexed_by is not None:
+			self._indexed_by._index = None
 
 	def _validate_sub( self, sub : T ) -> None:
 		# There is no way to check if sub is of type T here :/
 		pass
 	
-	def add_sub( self, sub : T ) -> None:
-		self._validate_sub( sub )
-		self._sub.append( sub )
-		
-	def add_subs( self, subs : typing.Sequence[T] ) -> None:
-		for sub in subs:
-			self.add_sub( sub )
+	def add_sub( self, sub : T, *, trusted : bool = False ) -> None:
+		"""
+			@param trusted The child comes from trusted code, such as the conversion of a parse
+				tree, and is checked at the trusted validation level
+		"""
+		if validation.should_validate( trusted ):
+			self._validate_sub( sub )
+		self._sub_changed()
+		if self._sub is _empty:
+			self._sub = [ sub ] # type: ignore[misc]
+		else:
+			self._sub.append( sub )
+		
+	def add_subs( self, subs : typing.Sequence[T], *, trusted : bool = False ) -> None:
+		if len(subs) == 0:
+			return
+		for sub in validation.select_for_validation( subs, trusted ):
+			self._validate_sub( sub )
+		self._sub_changed()
+		if self._sub is _empty:
+			self._sub = list( subs ) # type: ignore[misc]
+		else:
+			self._sub.extend( subs )
 			
 	def iter_sub( self ) -> typing.Sequence[T]:
 		return self._sub
@@ -78,37 +270,26 @@ class NodeContainer[T: Node]:
 	def first_sub( self ) -> T:
 		return self._sub[0]
 		
+	def iter_children( self ) -> typing.Sequence[T]:
+		return self._sub
+		
 	def visit_children( self, proc : VisitCallback ) -> None:
 		assert isinstance(self, Node), self
 		for node in self._sub:
 			node.visit( proc )
 			
-	def transform_children( self, proc: TransformCallback ) -> None:
-		at = 0
-		while at < len(self._sub):
-			node = self._sub[at]
-			trans_type, new_node = proc.transform( node )
-			match trans_type:
-				case TransformType.retain:
-					node.transform( proc )
-					
-				case TransformType.replace:
-					# We have no way to verify the type matches T
-					self._sub[at] = new_node # type: ignore[assignment]
-					new_node.transform( proc )
-					
-				case TransformType.delete:
-					del self._sub[ at ]
-					
-			at += 1
-			
 
 class BlockNode(Node):
+	__slots__ = ( 'comment', )
+	
 	def __init__(self):
 		super().__init__()
+		self.comment = None
 	
 class BlockContainer(NodeContainer[BlockNode], BlockNode):
-	def __init__(self, subs : typing.List[BlockNode] = []):
+	__slots__ = ( '_sub', '_indexed_by' )
+	
+	def __init__(self, subs : typing.Sequence[BlockNode] = ()):
 		super().__init__()
 		self.add_subs( subs )
 
@@ -117,11 +298,15 @@ class BlockContainer(NodeContainer[BlockNode], BlockNode):
 
 	
 class Element(Node):
+	__slots__ = ()
+	
 	def __init__(self):
 		super().__init__()
 		
 		
 class ElementContainer(NodeContainer[Element]):
+	__slots__ = ()
+	
 	def __init__(self):
 		super().__init__()
 
@@ -129,12 +314,16 @@ class ElementContainer(NodeContainer[Element]):
 		assert isinstance( sub, Element ), sub
 		
 class ParagraphElement(ElementContainer, Element):
-	def __init__(self, subs : typing.List[Element] = []):
+	__slots__ = ( '_sub', '_indexed_by' )
+	
+	def __init__(self, subs : typing.Sequence[Element] = ()):
 		super().__init__()
 		self.add_subs( subs )
 		
 class Paragraph(ElementContainer, BlockNode):
-	def __init__(self, subs = []):
+	__slots__ = ( '_sub', '_indexed_by' )
+	
+	def __init__(self, subs : typing.Sequence[Element] = ()):
 		super().__init__()
 		self.add_subs( subs )
 	
@@ -143,7 +332,9 @@ class Paragraph(ElementContainer, BlockNode):
 Leaf types may only inherit from Base node types. This prevents collision on simple visitors, as well as keeping the "is-a" relationships clean.
 """
 class Block(BlockContainer):
-	def __init__(self, class_ : BlockClass, subs: list[BlockNode] = [], *, args: list[str] = []):
+	__slots__ = ( '_class_', '_args' )
+	
+	def __init__(self, class_ : BlockClass, subs: typing.Sequence[BlockNode] = (), *, args: typing.Sequence[str] = ()):
 		super().__init__( subs )
 		self._class_ = class_
 		self._args = args
@@ -153,13 +344,29 @@ class Block(BlockContainer):
 		return self._class_
 		
 	@property
-	def args(self) -> list[str]:
+	def args(self) -> typing.Sequence[str]:
 		return self._args
 		
 		
+"""
+	Classes are interned by name: creating one with the name of an existing one returns that
+	one, including when loaded by pickle. They may thus be compared by identity.
+"""
 class BlockClass(object):
-	def __init__(self, name):
-		self.name = name
+	__slots__ = ( 'name', )
+	name : str
+	_interned : dict[str, BlockClass] = {}
+	
+	def __new__(cls, name : str):
+		interned = cls._interned.get( name )
+		if interned is None:
+			interned = super().__new__( cls )
+			interned.name = name
+			cls._interned[name] = interned
+		return interned
+		
+	def __reduce__(self):
+		return ( BlockClass, ( self.name, ) )
 		
 	def __str__(self) -> str:
 		return self.name
@@ -172,26 +379,113 @@ block_custom = BlockClass('custom')
 		
 		
 class Text(Element):
+	__slots__ = ( 'text', )
+	
 	def __init__(self, text : str):
 		super().__init__()
 		self.text = text
 	
 		
 class Inline(ParagraphElement):
+	__slots__ = ( 'feature', )
+	
 	def __init__(self, feature : InlineFeature):
 		super().__init__()
 		assert isinstance(feature, InlineFeature)
 		self.feature = feature
 		
 class SectionTitle(ElementContainer, BlockNode):
-	pass
+	__slots__ = ( '_sub', '_indexed_by' )
 	
+"""
+	The nodes of a document can be queried by type. The queries use an index of the tree,
+	built on the first query, and again on a query after children have been added to, or
+	transformed in, a container of this tree. Changes to other trees don't affect it. Other
+	changes, such as to a section title, aren't noticed, nor are those to a container which
+	is in several trees, other than the one indexed last.
+"""
 class RootSection(BlockContainer):
+	__slots__ = ( 'notes', '_index' )
+	
 	def __init__(self):
 		super().__init__()
 		self.notes : dict[str, NoteDefn] = {}
+		self._index : _NodeIndex | None = None
+		
+	def find_all[N: Node]( self, node_type : type[N] ) -> typing.Sequence[N]:
+		"""
+			@return the nodes of the type, including this one, in the order they're walked.
+				The sequence must not be modified.
+		"""
+		return self._get_index().find_all( node_type )
+		
+	def first[N: Node]( self, node_type : type[N] ) -> N | None:
+		found = self.find_all( node_type )
+		return found[0] if len(found) > 0 else None
+		
+	def any( self, node_type : type[Node] ) -> bool:
+		return len(self.find_all( node_type )) > 0
+		
+	def count( self, node_type : type[Node] ) -> int:
+		return len(self.find_all( node_type ))
+		
+	def parent_of( self, node : Node ) -> Node | None:
+		"""
+			@return the node the given one is a child of, or None for this one
+		"""
+		return self._get_index().parents[node]
+		
+	def __getstate__( self ):
+		# The index isn't stored, it's built again as needed
+		state, slots = typing.cast( tuple[typing.Any, dict[str, typing.Any]], super().__getstate__() )
+		return state, { **slots, '_index': None }
+		
+	def _get_index( self ) -> _NodeIndex:
+		if self._index is None:
+			self._index = _NodeIndex( self )
+		return self._index
+		
+		
+class _NodeIndex:
+	__slots__ = ( 'by_type', 'order', 'parents', 'found' )
+	
+	def __init__( self, root : RootSection ):
+		# The nodes of each concrete type, in the order walked
+		self.by_type : dict[type, list[Node]] = {}
+		self.order : dict[Node, int] = {}
+		self.parents : dict[Node, Node | None] = {}
+		# The results of queries, by the type queried
+		self.found : dict[type, typing.Sequence[Node]] = {}
+		
+		path : list[Node] = []
+		for event, node in walk( root ):
+			if event is WalkEvent.exit:
+				_ = path.pop()
+				continue
+				
+			self.parents[node] = path[-1] if len(path) > 0 else None
+			self.order[node] = len(self.order)
+			self.by_type.setdefault( type(node), [] ).append( node )
+			if isinstance( node, NodeContainer ):
+				node._indexed_by = root
+			path.append( node )
+			
+	def find_all( self, node_type : type ) -> typing.Sequence[typing.Any]:
+		found = self.found.get( node_type )
+		if found is None:
+			# A base type matches the nodes of several types, which are merged in order
+			matches = [ nodes for sub_type, nodes in self.by_type.items() if issubclass( sub_type, node_type ) ]
+			if len(matches) == 0:
+				found = _no_children
+			elif len(matches) == 1:
+				found = matches[0]
+			else:
+				found = list( heapq.merge( *matches, key = self.order.__getitem__ ) )
+			self.found[node_type] = found
+		return found
 	
 class Section(BlockContainer):
+	__slots__ = ( 'title', 'level' )
 	title : typing.Optional[SectionTitle]
 	
 	def __init__(self, level, title_text_block : typing.Optional[typing.List[ElementContainer]] = None ):
@@ -204,28 +498,43 @@ class Section(BlockContainer):
 			self.title = None
 		self.level = level
 		
-	def visit( self, proc : VisitCallback ) -> None:
-		if proc.enter( self ):
-			if self.title is not None:
-				self.title.visit( proc )
-				
-			for node in self._sub:
-				node.visit( proc )
-		proc.exit( self )
+	def iter_children( self ) -> typing.Sequence[BlockNode]:
+		if self.title is None:
+			return self._sub
+		return [ self.title, *self._sub ]
 	
 
 class ListItem(BlockContainer):
+	__slots__ = ()
+	
 	def __init__(self):
 		super().__init__()
 
 class List(NodeContainer[ListItem], BlockNode):
+	__slots__ = ( '_sub', '_indexed_by' )
+	
 	def _validate_sub( self, sub : ListItem ) -> None:
 		assert isinstance( sub, ListItem ), sub
 
 		
+"""
+	Features are interned by name, as are `BlockClass` instances.
+"""
 class InlineFeature(object):
-	def __init__(self, name : str):
-		self.name = name
+	__slots__ = ( 'name', )
+	name : str
+	_interned : dict[str, InlineFeature] = {}
+	
+	def __new__(cls, name : str):
+		interned = cls._interned.get( name )
+		if interned is None:
+			interned = super().__new__( cls )
+			interned.name = name
+			cls._interned[name] = interned
+		return interned
+		
+	def __reduce__(self):
+		return ( InlineFeature, ( self.name, ) )
 
 feature_none = InlineFeature("none")
 feature_bold = InlineFeature("bold")
@@ -235,6 +544,8 @@ feature_header = InlineFeature("header")
 feature_latex = InlineFeature("latex")
 
 class Link(ParagraphElement):
+	__slots__ = ( 'url', 'title', 'note_id' )
+	
 	def __init__(self, *, url : str | None= None, note_id: str | None = None, title : typing.Optional[str] = None ):
 		super().__init__()
 		self.url = url
@@ -244,22 +555,30 @@ class Link(ParagraphElement):
 		
 
 class Note(ParagraphElement):
+	__slots__ = ( 'text', )
+	
 	def __init__(self, text: str):
 		super().__init__()
 		self.text = text
 		
 class NoteDefn(ElementContainer, BlockNode):
-	def __init__(self, text: str, elements : typing.Sequence[Element] = [] ):
+	__slots__ = ( '_sub', '_indexed_by', 'text' )
+	
+	def __init__(self, text: str, elements : typing.Sequence[Element] = () ):
 		super().__init__()
 		self.add_subs( elements )
 		self.text = text
 		
 class Token(ParagraphElement):
+	__slots__ = ( 'args', )
+	
 	def __init__(self, args : typing.List[str]):
 		super().__init__()
 		self.args = args
 		
 class Code(BlockNode):
+	__slots__ = ( 'text', 'class_' )
+	
 	def __init__(self, text : str, class_ : str):
 		super().__init__()
 		self.text = text
@@ -271,6 +590,8 @@ class EmbedClass(Enum):
 	document = 3
 	
 class Embed(BlockNode):
+	__slots__ = ( 'class_', 'url', 'alt' )
+	
 	def __init__(self, class_ : EmbedClass, url : str ):
 		super().__init__()
 		self.class_ = class_
@@ -282,6 +603,8 @@ class MarkClass(Enum):
 	minor_separator = 1
 
 class BlockMark(BlockNode):
+	__slots__ = ( 'class_', )
+	
 	def __init__(self, class_ : MarkClass):
 		super().__init__()
 		self.class_ = class_
@@ -1,4 +1,5 @@
 from . import tree_parser, parse_to_doc, doc_tree, doc_tree_dump, structure, parse_tree_dump
+from .doc_cache import DocumentCache
 from typing import *
 
 class Document:
@@ -40,7 +41,12 @@ def dump_document( doc : Document, *, _first = True ) -> str:
 		text += dump_document( sub, _first = False )
 	return text
 		
+"""
+	@param cache If provided, the document is taken from the cache when the file is unchanged,
+		otherwise it's loaded and stored in the cache
+"""
 def load_document( path : str, *, 
+	cache : Optional[DocumentCache] = None,
 	_dump_parse = False,
 	_write_parse = None,
 	_write_doc = None,
@@ -49,6 +55,99 @@ def load_document( path : str, *,
 	_dump_doc = False,
 	) -> Document:
 	
+	# The debugging outputs need the document to be loaded
+	if cache is None or _dump_parse or _write_parse or _write_predoc or _dump_predoc:
+		return _load_document( path, 
+			_dump_parse = _dump_parse, _write_parse = _write_parse,
+			_write_predoc = _write_predoc, _dump_predoc = _dump_predoc )
+		
+	# The document is parsed from the bytes hashed, thus it matches the key even if the file
+	# changes meanwhile
+	with open( path, 'rb' ) as in_file:
+		data = in_file.read()
+	key = cache.get_key( data )
+	doc = cache.get( key )
+	if doc is None:
+		doc = _load_document_fused( path, data = data )
+		cache.put( key, doc )
+	return doc
+	
+	
+def _load_document( path : str, *, 
+	_dump_parse = False,
+	_write_parse = None,
+	_write_predoc = None,
+	_dump_predoc = False,
+	) -> Document:
+	
+	# The parse outputs need the whole parse tree
+	if _dump_parse or _write_parse:
+		doc = _load_document_two_pass( path, _dump_parse = _dump_parse, _write_parse = _write_parse )
+	else:
+		doc = _load_document_fused( path )
+		
+	if _dump_predoc:
+		print( dump_document( doc ) )
+	if _write_predoc:
+		with open( _write_predoc, 'w', encoding = 'utf-8' ) as out:
+			out.write( dump_document( doc ) )
+		
+	return doc
+	
+	
+"""
+	Converts each top-level block to the document tree once it's parsed, thus the parse tree
+	of the whole file is never built. Errors are reported as by `_load_document_two_pass`: 
+	a parse error takes precedence over an error converting an earlier block.
+	
+	@param data The bytes of the file, if already read
+"""
+def _load_document_fused( path : str, *, data : Optional[bytes] = None ) -> Document:
+	doc = Document()
+	cur_doc = doc
+	converter = parse_to_doc.BlockConverter()
+	started = False
+	error : Optional[Exception] = None
+	
+	def on_blocks( blocks : Sequence[tree_parser.Node] ) -> None:
+		nonlocal cur_doc, converter, started, error
+		if error is not None:
+			return
+			
+		try:
+			for block in blocks:
+				if block.type == tree_parser.NodeType.matter:
+					meta = structure.structure_parse( block.text, block.location )
+					# Matter after the first block starts a sub-document
+					if not started:
+						doc.set_meta( meta )
+					else:
+						cur_doc.set_root( converter.finish() )
+						cur_doc = Document()
+						doc.sub.append( cur_doc )
+						cur_doc.set_meta( meta )
+						converter = parse_to_doc.BlockConverter()
+				else:
+					converter.add_blocks( ( block, ) )
+				started = True
+		except Exception as e:
+			error = e
+		
+	tp = tree_parser.TreeParser()
+	tp.parse_file_blocks( path, on_blocks, data = data )
+	if error is not None:
+		raise error
+		
+	assert started
+	cur_doc.set_root( converter.finish() )
+	return doc
+	
+	
+def _load_document_two_pass( path : str, *, 
+	_dump_parse = False,
+	_write_parse = None,
+	) -> Document:
+	
 	tp = tree_parser.TreeParser()
 	node = tp.parse_file( path )
 	if _dump_parse:
@@ -98,13 +197,6 @@ def load_document( path : str, *,
 	
 	root = parse_to_doc.convert( scan_node )
 	cur_doc.set_root( root )
-	
-	if _dump_predoc:
-		print( dump_document( doc ) )
-	if _write_predoc:
-		with open( _write_predoc, 'w', encoding = 'utf-8' ) as out:
-			out.write( dump_document( doc ) )
-		
 	return doc
 	
 __all__ = [ 'Document', 'load_document', 'dump_document' ]
@@ -0,0 +1,231 @@
+# An array-backed parse tree
+from __future__ import annotations # type: ignore
+from typing import *
+from array import array
+
+from .source import Source, SourceLocation
+from .parse_tree import Node, NodeType, Annotation
+
+__all__ = [ 'FlatTree', 'FlatNode' ]
+
+_no_node = -1
+_node_types = { node_type.value: node_type for node_type in NodeType }
+
+
+"""
+	A parse tree held in parallel arrays, with one entry per node, instead of `Node` objects.
+	Text that appears unchanged in the source is kept as a span of the source, other text,
+	such as that with replacements applied, in a string table.
+
+	Nodes are read through `FlatNode` views, which offer the reading part of the `Node`
+	interface. A view is created as a node is visited, and isn't kept by the tree.
+"""
+class FlatTree:
+	def __init__( self, source : Source ):
+		self._source = source
+
+		self._type = array('i')
+		self._class_id = array('i')
+		self._parent = array('i')
+		self._first_child = array('i')
+		self._next_sibling = array('i')
+		self._start = array('i')
+		self._end = array('i')
+		# A span of the source if the start isn't negative, else the end is an index in _strings
+		self._text_start = array('i')
+		self._text_end = array('i')
+		# An index in _extras for the args and annotations of the node, or _no_node
+		self._extra = array('i')
+
+		self._classes : List[str] = []
+		self._class_ids : Dict[str, int] = {}
+		self._strings : List[str] = []
+		self._extras : List[Tuple[List[str], List[Tuple[str, List[str], int]]]] = []
+
+		self._root = self._add( Node( NodeType.container, source.location ), _no_node )
+		self._last_block = _no_node
+
+	@property
+	def root( self ) -> FlatNode:
+		return FlatNode( self, self._root )
+
+	def __len__( self ) -> int:
+		return len(self._type)
+
+	def append_blocks( self, blocks : Sequence[Node] ) -> None:
+		"""
+			Adds completed blocks to the end of the root container. The `Node` objects aren't
+			referenced by the tree, and can be released once added.
+		"""
+		for block in blocks:
+			index = self._add_tree( block, self._root )
+			if self._last_block == _no_node:
+				self._first_child[self._root] = index
+			else:
+				self._next_sibling[self._last_block] = index
+			self._last_block = index
+
+	def set_end( self, end : int ) -> None:
+		self._end[self._root] = end
+
+	def _add_tree( self, node : Node, parent : int ) -> int:
+		top = self._add( node, parent )
+		pending = [ ( node, top ) ]
+		while len(pending) > 0:
+			node, index = pending.pop()
+			prev = _no_node
+			for sub in node.iter_sub():
+				sub_index = self._add( sub, index )
+				if prev == _no_node:
+					self._first_child[index] = sub_index
+				else:
+					self._next_sibling[prev] = sub_index
+				prev = sub_index
+				pending.append( ( sub, sub_index ) )
+
+		return top
+
+	def _add( self, node : Node, parent : int ) -> int:
+		assert not node.has_attr()
+		index = len(self._type)
+		offset = node.location.offset
+
+		self._type.append( node.type.value )
+		self._class_id.append( self._get_class_id( node.class_ ) )
+		self._parent.append( parent )
+		self._first_child.append( _no_node )
+		self._next_sibling.append( _no_node )
+		self._start.append( offset )
+		self._end.append( node.end_offset )
+
+		text_start, text_end = self._get_text_span( node.text, offset, node.end_offset )
+		self._text_start.append( text_start )
+		self._text_end.append( text_end )
+
+		self._extra.append( _no_node )
+		if node.has_args() or node.has_annotations():
+			# Annotation nodes are added after this one, as trees without a parent
+			annotations = [
+				( anno.class_, anno.args, self._add_tree( anno.node, _no_node ) if anno.node is not None else _no_node )
+				for anno in node.iter_annotations()
+			]
+			self._extra[index] = len(self._extras)
+			self._extras.append( ( node.get_args(), annotations ) )
+
+		return index
+
+	def _get_class_id( self, class_ : str ) -> int:
+		class_id = self._class_ids.get( class_ )
+		if class_id is None:
+			class_id = len(self._classes)
+			self._classes.append( class_ )
+			self._class_ids[class_] = class_id
+		return class_id
+
+	def _get_text_span( self, text : str, offset : int, end : int ) -> Tuple[int, int]:
+		if len(text) == 0:
+			return 0, 0
+
+		# The text of a node lies around its location, though not always after it
+		at = self._source.text.find( text, max( offset - len(text), 0 ), max( end, offset + len(text) ) )
+		if at >= 0:
+			return at, at + len(text)
+
+		self._strings.append( text )
+		return -1, len(self._strings) - 1
+
+	def _get_text( self, index : int ) -> str:
+		start = self._text_start[index]
+		if start < 0:
+			return self._strings[self._text_end[index]]
+		return self._source.text[start:self._text_end[index]]
+
+
+"""
+	A view of one node of a `FlatTree`.
+"""
+class FlatNode:
+	__slots__ = ( '_tree', '_index' )
+
+	def __init__( self, tree : FlatTree, index : int ):
+		self._tree = tree
+		self._index = index
+
+	def __str__( self ) -> str:
+		return f"{self.type}/{self.class_}:{self.location.translate()} \"{self.text}\""
+
+	@property
+	def type( self ) -> NodeType:
+		return _node_types[self._tree._type[self._index]]
+
+	@property
+	def class_( self ) -> str:
+		return self._tree._classes[self._tree._class_id[self._index]]
+
+	@property
+	def text( self ) -> str:
+		return self._tree._get_text( self._index )
+
+	@property
+	def location( self ) -> SourceLocation:
+		return SourceLocation( self._tree._source, self._tree._start[self._index] )
+
+	@property
+	def end_offset( self ) -> int:
+		return self._tree._end[self._index]
+
+	@property
+	def parent( self ) -> Optional[FlatNode]:
+		parent = self._tree._parent[self._index]
+		return FlatNode( self._tree, parent ) if parent != _no_node else None
+
+	def iter_sub( self ) -> List[FlatNode]:
+		subs = []
+		at = self._tree._first_child[self._index]
+		while at != _no_node:
+			subs.append( FlatNode( self._tree, at ) )
+			at = self._tree._next_sibling[at]
+		return subs
+
+	def sub_is_empty( self ) -> bool:
+		return self._tree._first_child[self._index] == _no_node
+
+	def sub_last( self ) -> Optional[FlatNode]:
+		subs = self.iter_sub()
+		return subs[-1] if len(subs) > 0 else None
+
+	def get_args( self ) -> List[str]:
+		extra = self._tree._extra[self._index]
+		if extra == _no_node:
+			return []
+		return list( self._tree._extras[extra][0] )
+
+	def has_args( self ) -> bool:
+		return len(self.get_args()) > 0
+
+	def iter_annotations( self ) -> Iterator[Annotation]:
+		extra = self._tree._extra[self._index]
+		if extra == _no_node:
+			return
+		for class_, args, node in self._tree._extras[extra][1]:
+			yield Annotation( class_, args = args,
+				node = cast(Node, FlatNode( self._tree, node )) if node != _no_node else None )
+
+	def has_annotations( self ) -> bool:
+		extra = self._tree._extra[self._index]
+		return extra != _no_node and len(self._tree._extras[extra][1]) > 0
+
+	def get_annotation( self, class_ : str ) -> Optional[Annotation]:
+		for anno in self.iter_annotations():
+			if anno.class_ == class_:
+				return anno
+		return None
+
+	def has_attr( self ) -> bool:
+		return False
+
+	def iter_attr( self ) -> Iterator[FlatNode]:
+		return iter([])
+
+	def get_attrs( self ) -> List[FlatNode]:
+		return []
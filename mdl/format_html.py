@@ -32,6 +32,8 @@ class XmlFormatter(tree_formatter.TreeFormatter):
 		
 		
 class HtmlWriter(render.Writer):
+	_unknown_node_message = "Unknown node type"
+	
 	def __init__(
 		self, *, 
 		body_only: bool = False, 
@@ -54,7 +56,16 @@ class HtmlWriter(render.Writer):
 		
 	def render( self, doc : document.Document ) -> str:
 		self._reset()
+		self._write_document( doc )
+		return self.output.value
+		
+	def render_to( self, doc : document.Document, stream : TextIO ) -> None:
+		self._reset()
+		self.output.stream_to( stream )
+		self._write_document( doc )
+		self.output.flush()
 		
+	def _write_document( self, doc : document.Document ) -> None:
 		if not self._body_only:
 			self.output.block( "html" )
 			self.output.block( "head" )
@@ -80,8 +91,6 @@ class HtmlWriter(render.Writer):
 		
 		self._write_notes()
 		
-		return self.output.value
-		
 	def enter( self, node : doc_tree.Node ) -> bool:
 		self.output.open_context()
 		res = self._write_node( node )
@@ -93,40 +102,6 @@ class HtmlWriter(render.Writer):
 		assert back == node
 		self.output.end_context()
 		
-		
-	def _write_node( self, node : doc_tree.Node ) -> bool:
-		result = False
-		def q( type, func ):
-			nonlocal result
-			if isinstance( node, type ):
-				result = func( node )
-				return True
-			return False
-
-		def fail():
-			raise Exception( "Unknown node type", node )
-		
-		_ = \
-			q( doc_tree.Block, self._write_block ) or \
-			q( doc_tree.Code, self._write_code ) or \
-			q( doc_tree.Inline, self._write_inline ) or \
-			q( doc_tree.Link, self._write_link ) or \
-			q( doc_tree.List, self._write_list ) or \
-			q( doc_tree.ListItem, self._write_list_item ) or \
-			q( doc_tree.Note, self._write_note ) or \
-			q( doc_tree.RootSection, self._write_root_section ) or \
-			q( doc_tree.Section, self._write_section ) or \
-			q( doc_tree.SectionTitle, self._write_section_title ) or \
-			q( doc_tree.Text, self._write_text ) or \
-			q( doc_tree.Paragraph, self._write_paragraph ) or \
-			q( doc_tree.Embed, self._write_embed ) or \
-			q( doc_tree.BlockMark, self._write_block_mark ) or \
-			q( doc_tree.NoteDefn, self._write_note_defn) or \
-			fail()
-			
-		return result
-
-			
 	def _write_note_defn(self, node: doc_tree.NoteDefn) -> bool:
 		return False
 	
@@ -323,3 +298,22 @@ class HtmlWriter(render.Writer):
 		else:
 			assert False
 		return True
+
+
+HtmlWriter.register_handlers( {
+	doc_tree.Block: '_write_block',
+	doc_tree.Code: '_write_code',
+	doc_tree.Inline: '_write_inline',
+	doc_tree.Link: '_write_link',
+	doc_tree.List: '_write_list',
+	doc_tree.ListItem: '_write_list_item',
+	doc_tree.Note: '_write_note',
+	doc_tree.RootSection: '_write_root_section',
+	doc_tree.Section: '_write_section',
+	doc_tree.SectionTitle: '_write_section_title',
+	doc_tree.Text: '_write_text',
+	doc_tree.Paragraph: '_write_paragraph',
+	doc_tree.Embed: '_write_embed',
+	doc_tree.BlockMark: '_write_block_mark',
+	doc_tree.NoteDefn: '_write_note_defn',
+} )
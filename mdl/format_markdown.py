@@ -33,11 +33,19 @@ class MarkdownWriter(render.Writer):
 		self.stack : List[StackItem] = []
 		
 	def render(self, doc : document.Document ) -> str:
+		self._write_document( doc )
+		return self.output.value
+		
+	def render_to(self, doc : document.Document, stream : TextIO ) -> None:
+		self.output.stream_to( stream )
+		self._write_document( doc )
+		self.output.flush()
+		
+	def _write_document(self, doc : document.Document ) -> None:
 		if doc.root is not None:
 			doc.root.visit( self )
 			
 		self._write_notes()
-		return self.output.value
 		
 	def render_node( self, node : doc_tree.Node ) -> str:
 		node.visit( self )
@@ -57,38 +65,6 @@ class MarkdownWriter(render.Writer):
 		assert back.node == node
 		self.output.end_context()
 		
-	
-	def _write_node( self, node : doc_tree.Node ) -> bool:
-		result = False
-		def q( match_type, func : Callable[[Any], bool]) -> bool:
-			nonlocal result
-			if isinstance( node, match_type ):
-				result = func( node )
-				return True
-			return False
-
-		def fail():
-			raise Exception( "unknown-node-type", node )
-		
-		_ = \
-			q( doc_tree.Block, self._write_block ) or \
-			q( doc_tree.Code, self._write_code ) or \
-			q( doc_tree.Embed, self._write_embed ) or \
-			q( doc_tree.Inline, self._write_inline ) or \
-			q( doc_tree.Link, self._write_link ) or \
-			q( doc_tree.ListItem, self._write_list_item ) or \
-			q( doc_tree.List, self._write_list ) or \
-			q( doc_tree.Note, self._write_note ) or \
-			q( doc_tree.Paragraph, self._write_paragraph ) or \
-			q( doc_tree.Section, self._write_section ) or \
-			q( doc_tree.SectionTitle, self._write_section_title ) or \
-			q( doc_tree.Text, self._write_text ) or \
-			q( doc_tree.BlockMark, self._write_block_mark ) or \
-			fail()
-			
-		return result
-
-			
 	inline_map = {
 		"italic": ( "_", "_" ),
 		"bold": ( "**", "**" ),
@@ -165,9 +141,16 @@ class MarkdownWriter(render.Writer):
 
 		raise Exception( "unknown-block-type", node.class_.name )
 		
+	def _write_root_section( self, node : doc_tree.RootSection ) -> bool:
+		return True
+		
 	def _write_section( self, node : doc_tree.Section ) -> bool:
 		return True
 		
+	def _write_note_defn( self, node : doc_tree.NoteDefn ) -> bool:
+		# Written with the notes, at the end
+		return False
+		
 	def _write_section_title( self, node : doc_tree.SectionTitle ) -> bool:
 		parent = self.stack[-2].node
 		assert isinstance( parent, doc_tree.Section )
@@ -276,3 +259,22 @@ def _split_flow( text : str ) -> Tuple[str, str, str]:
 	match = _split_flow_re.match( text )
 	assert match != None
 	return ( match.group(1), match.group(2), match.group(3) )
+
+
+MarkdownWriter.register_handlers( {
+	doc_tree.Block: '_write_block',
+	doc_tree.Code: '_write_code',
+	doc_tree.Embed: '_write_embed',
+	doc_tree.Inline: '_write_inline',
+	doc_tree.Link: '_write_link',
+	doc_tree.ListItem: '_write_list_item',
+	doc_tree.List: '_write_list',
+	doc_tree.Note: '_write_note',
+	doc_tree.NoteDefn: '_write_note_defn',
+	doc_tree.Paragraph: '_write_paragraph',
+	doc_tree.RootSection: '_write_root_section',
+	doc_tree.Section: '_write_section',
+	doc_tree.SectionTitle: '_write_section_title',
+	doc_tree.Text: '_write_text',
+	doc_tree.BlockMark: '_write_block_mark',
+} )
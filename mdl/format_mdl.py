@@ -14,7 +14,7 @@ class MdlFormatter(tree_formatter.TreeFormatter):
 		self.write( " ".join( self.escape_arg(text) for text in texts ) )
 		
 	# TODO: Why are these args comma separated, should be space separated
-	def comma_args( self, texts: list[str]) -> None:
+	def comma_args( self, texts: typing.Sequence[str]) -> None:
 		self.write( ",".join( self.escape_arg(text) for text in texts ) )
 	
 	def escape_arg( self, text: str )-> str:
@@ -44,6 +44,11 @@ class MdlWriter(render.Writer):
 		self._render_doc( doc, True )
 		return self.output.value
 		
+	def render_to(self, doc: document.Document, stream : typing.TextIO ) -> None:
+		self.output.stream_to( stream )
+		self._render_doc( doc, True )
+		self.output.flush()
+		
 	def _render_doc( self, doc: document.Document, first: bool ) -> None:
 		if not first or len(doc.meta) > 0:
 			self.output.write("+++\n")
@@ -96,39 +101,6 @@ class MdlWriter(render.Writer):
 		self.output.end_context()
 
 		
-	def _write_node( self, node : doc_tree.Node ) -> bool:
-		result = False
-		def q( match_type, func : typing.Callable[[typing.Any], bool]) -> bool:
-			nonlocal result
-			if isinstance( node, match_type ):
-				result = func( node )
-				return True
-			return False
-
-		def fail():
-			raise Exception( "unknown-node-type", node )
-		
-		_ = \
-			q( doc_tree.Block, self._write_block ) or \
-			q( doc_tree.Code, self._write_code ) or \
-			q( doc_tree.Embed, self._write_embed ) or \
-			q( doc_tree.Inline, self._write_inline ) or \
-			q( doc_tree.Link, self._write_link ) or \
-			q( doc_tree.ListItem, self._write_list_item ) or \
-			q( doc_tree.List, self._write_list ) or \
-			q( doc_tree.Note, self._write_note ) or \
-			q( doc_tree.NoteDefn, self._write_note_defn) or \
-			q( doc_tree.Paragraph, self._write_paragraph ) or \
-			q( doc_tree.RootSection, self._write_root_section ) or \
-			q( doc_tree.Section, self._write_section ) or \
-			q( doc_tree.SectionTitle, self._write_section_title ) or \
-			q( doc_tree.Text, self._write_text ) or \
-			q( doc_tree.Token, self._write_token ) or \
-			q( doc_tree.BlockMark, self._write_block_mark ) or \
-			fail()
-			
-		return result
-		
 	def _write_block_comment( self, node: doc_tree.Node ) -> None:
 		# IMPROVE: comments don't really work yet. It's not clear if they're meant to contain
 		# nodes or just text.
@@ -257,4 +229,23 @@ class MdlWriter(render.Writer):
 		self.output.args( node.args )
 		self.output.write( "}" )
 		return False
-	
+
+
+MdlWriter.register_handlers( {
+	doc_tree.Block: '_write_block',
+	doc_tree.Code: '_write_code',
+	doc_tree.Embed: '_write_embed',
+	doc_tree.Inline: '_write_inline',
+	doc_tree.Link: '_write_link',
+	doc_tree.ListItem: '_write_list_item',
+	doc_tree.List: '_write_list',
+	doc_tree.Note: '_write_note',
+	doc_tree.NoteDefn: '_write_note_defn',
+	doc_tree.Paragraph: '_write_paragraph',
+	doc_tree.RootSection: '_write_root_section',
+	doc_tree.Section: '_write_section',
+	doc_tree.SectionTitle: '_write_section_title',
+	doc_tree.Text: '_write_text',
+	doc_tree.Token: '_write_token',
+	doc_tree.BlockMark: '_write_block_mark',
+} )
@@ -1,6 +1,7 @@
 # Convert the parse tree to a document tree
 from . import doc_tree
 from . import tree_parser
+from . import flat_tree
 from typing import *
 
 class _ConvertContext(object, ):
@@ -21,109 +22,178 @@ class _ConvertContext(object, ):
 
 """
 An iterator for the nodes that allows for nested iteration and peeking.
+
+It is a cursor over the sequence given, such as the children of a node from `iter_sub`,
+and doesn't copy it. The sequence must not change during the iteration.
 """
 class _NodeIterator(object):
-	def __init__(self, nodes):
-		self._nodes = list( nodes )
+	__slots__ = ( '_nodes', '_at', '_end' )
+	
+	def __init__(self, nodes : Sequence[Any]):
+		self._nodes = nodes
 		self._at = 0
+		self._end = len(nodes)
 		
 	def if_next(self):
-		if self._at < len(self._nodes):
+		if self._at < self._end:
 			res = self._nodes[self._at]
 			self._at += 1
 			return res
 		return None
 		
 	def peek_next(self):
-		assert self._at < len(self._nodes)
+		assert self._at < self._end
 		return self._nodes[self._at]
 		
 	def if_peek_next(self):
-		if self._at >= len(self._nodes):
+		if self._at >= self._end:
 			return None
 		return self._nodes[self._at]
 		
 	def next(self):
-		assert self._at < len(self._nodes)
+		assert self._at < self._end
 		res = self._nodes[self._at]
 		self._at += 1
 		return res
 		
 	def has_next(self):
-		return self._at < len(self._nodes)
+		return self._at < self._end
 		
 
-def convert( node : tree_parser.Node ) -> doc_tree.RootSection:
-	assert node.type == tree_parser.NodeType.container
-	
-	root = doc_tree.RootSection()
-	ctx = _ConvertContext(root)
-	try:
-		subs = _convert_blocks( ctx, _NodeIterator(node.iter_sub()) )
-		root.add_subs( subs )
-	except:
-		ctx.print_where()
-		raise
-	
-	return root
+"""
+	@param node The root of a parse tree, or a flat parse tree
+"""
+def convert( node : Union[tree_parser.Node, flat_tree.FlatTree] ) -> doc_tree.RootSection:
+	if isinstance( node, flat_tree.FlatTree ):
+		return _convert_root( node.root )
+	return _convert_root( node )
 	
+def _convert_root( node : Union[tree_parser.Node, flat_tree.FlatNode] ) -> doc_tree.RootSection:
+	assert node.type == tree_parser.NodeType.container
 	
-def _convert_blocks( ctx: _ConvertContext, nodes_iter: _NodeIterator ) -> List[doc_tree.BlockNode]:
-	out: List[doc_tree.BlockNode] = []
+	converter = BlockConverter()
+	converter.add_blocks( node.iter_sub() )
+	return converter.finish()
 	
-	section_stack: List[doc_tree.Section] = []
-	cur_out = out
-	prev_in_section = None
 	
-	def append_block( para ):
-		nonlocal cur_out, prev_in_section
-		if isinstance(para, doc_tree.Section):
-			while para.level <= len(section_stack):
-				_ = section_stack.pop()
+"""
+Converts the top-level blocks of a parse tree as they are parsed, instead of once the whole
+tree is. The blocks are added in order, in as many calls as needed, and the document root is
+returned by `finish`.
+"""
+class BlockConverter(object):
+	def __init__(self):
+		self._root = doc_tree.RootSection()
+		self._ctx = _ConvertContext(self._root)
+		self._out: List[doc_tree.BlockNode] = []
+		self._appender = _BlockAppender(self._out)
+		
+	def add_blocks(self, nodes : Sequence[Any]) -> None:
+		try:
+			self._appender.add_nodes( self._ctx, _NodeIterator(nodes) )
+		except:
+			self._ctx.print_where()
+			raise
 			
-			if len(section_stack) > 0:
-				cur_out = section_stack[-1]._sub #TODO: fix!
-			else:
-				cur_out = out
+	def finish(self) -> doc_tree.RootSection:
+		try:
+			self._root.add_subs( self._out, trusted = True )
+		except:
+			self._ctx.print_where()
+			raise
+		return self._root
+		
+		
+"""
+Adds converted blocks to a list, or to the section they follow. It's kept between calls
+to `add_nodes`, thus the blocks may be converted in several runs.
+"""
+class _BlockAppender(object):
+	def __init__(self, out: List[doc_tree.BlockNode]):
+		self._out = out
+		self._section_stack: List[doc_tree.Section] = []
+		self._prev_in_section: Optional[doc_tree.BlockNode] = None
+		
+	def append_block( self, para ):
+		if isinstance(para, doc_tree.Section):
+			while para.level <= len(self._section_stack):
+				_ = self._section_stack.pop()
 			
-			cur_out.append( para )
-			section_stack.append( para )
-			cur_out = para._sub #TODO: Fix!
-			prev_in_section = None if len(cur_out) == 0 else cur_out[-1]
+			self._add_to_section( para )
+			self._section_stack.append( para )
+			self._prev_in_section = None if para.len_sub() == 0 else para.iter_sub()[-1]
 		elif para != None:
-			cur_out.append( para )
-			prev_in_section = para
-
-	
-	while nodes_iter.has_next():
-		node = nodes_iter.peek_next()
-		ctx.where_push(node)
-
-		if node.type == tree_parser.NodeType.raw:
-			node = nodes_iter.next()
-			code = doc_tree.Code(node.text, node.class_)
-			append_block( code )
+			self._add_to_section( para )
+			self._prev_in_section = para
 			
-		elif node.type == tree_parser.NodeType.block:
-			para = _convert_block( ctx, nodes_iter, prev_in_section )
-			append_block( para )
+	def _add_to_section( self, para ):
+		if len(self._section_stack) > 0:
+			self._section_stack[-1].add_sub( para, trusted = True )
+		else:
+			self._out.append( para )
+			
+	def add_nodes( self, ctx: _ConvertContext, nodes_iter: _NodeIterator ) -> None:
+		# Containers are converted with an explicit stack, rather than recursively, so that any
+		# nesting the parser accepts is converted.
+		frames: List[_ContainerFrame] = []
+		appender = self
+		while True:
+			if not nodes_iter.has_next():
+				if len(frames) == 0:
+					break
+				frame = frames.pop()
+				para = _convert_block_subs( ctx, frame.node, frame.out, frame.prev_in_section )
+				nodes_iter, appender = frame.nodes_iter, frame.appender
+				appender.append_block( para )
+				ctx.where_pop()
+				continue
 				
-		elif node.type == tree_parser.NodeType.container:
-			node = nodes_iter.next()
-			para = _convert_block( ctx, _NodeIterator([ node ]), prev_in_section )
-			append_block( para )
+			node = nodes_iter.peek_next()
+			ctx.where_push(node)
 			
-		elif node.type == tree_parser.NodeType.matter:
-			_ = nodes_iter.next()
-			pass
+			if node.type == tree_parser.NodeType.container:
+				_ = nodes_iter.next()
+				frame = _ContainerFrame( node, nodes_iter, appender )
+				frames.append( frame )
+				nodes_iter = _NodeIterator( node.iter_sub() )
+				appender = _BlockAppender( frame.out )
+				continue
+				
+			convert_type = _block_type_handlers.get( node.type )
+			if convert_type is None:
+				raise Exception("Unexpected block type", node)
+			appender.append_block( convert_type( ctx, nodes_iter, appender._prev_in_section ) )
 			
-		else:
-			raise Exception("Unexpected block type", node)
+			ctx.where_pop()
 			
-		ctx.where_pop()
 			
+"""
+A container whose children are being converted, with where to resume once they are.
+"""
+class _ContainerFrame(object):
+	__slots__ = ( 'node', 'nodes_iter', 'appender', 'out', 'prev_in_section' )
+	
+	def __init__(self, node, nodes_iter: _NodeIterator, appender: _BlockAppender):
+		self.node = node
+		self.nodes_iter = nodes_iter
+		self.appender = appender
+		self.out: List[doc_tree.BlockNode] = []
+		self.prev_in_section = appender._prev_in_section
+		
+		
+def _convert_blocks( ctx: _ConvertContext, nodes_iter: _NodeIterator ) -> List[doc_tree.BlockNode]:
+	out: List[doc_tree.BlockNode] = []
+	_BlockAppender(out).add_nodes( ctx, nodes_iter )
 	return out
 
+def _convert_raw( ctx: _ConvertContext, nodes_iter: _NodeIterator, prev_in_section ):
+	node = nodes_iter.next()
+	return doc_tree.Code(node.text, node.class_)
+
+def _skip_matter( ctx: _ConvertContext, nodes_iter: _NodeIterator, prev_in_section ):
+	_ = nodes_iter.next()
+	return None
+
 def _convert_inlines( ctx: _ConvertContext, node: tree_parser.Node ):
 	para_subs: List[doc_tree.Node] = []
 	nodes_iter = _NodeIterator( node.iter_sub() )
@@ -146,97 +216,145 @@ def _as_text( ctx, block : doc_tree.ElementContainer ) -> str:
 		txt += element.text
 	return txt
 	
+"""
+The annotations of a node by class. Where a class repeats, the first one is kept, as with
+`get_annotation`.
+"""
+def _index_annotations( node ) -> Dict[str, tree_parser.Annotation]:
+	annotations: Dict[str, tree_parser.Annotation] = {}
+	for anno in node.iter_annotations():
+		annotations.setdefault( anno.class_, anno )
+	return annotations
+
 def _convert_block( ctx: _ConvertContext, nodes_iter: _NodeIterator, prev_in_section ):
-	para: Optional[doc_tree.Node] = None
+	node = nodes_iter.next()
+	para_subs: List[doc_tree.BlockNode] = [ doc_tree.Paragraph( _convert_inlines( ctx, node ) ) ]
+	return _convert_block_subs( ctx, node, para_subs, prev_in_section )
 	
-	while True:
-		node = nodes_iter.next()
-			
-		para_subs: List[doc_tree.BlockNode]
-		if node.type == tree_parser.NodeType.block:
-			para_subs = [ doc_tree.Paragraph( _convert_inlines( ctx, node ) ) ]
-		else:
-			para_subs = _convert_blocks( ctx, _NodeIterator(node.iter_sub() ))
-			
-		if node.class_.startswith( '^' ):
-			if not node.text in ctx.open_notes:
-				raise Exception( f'There is no reference to this note "{node.text}"' )
-			assert len(para_subs) == 1 and isinstance(para_subs[0], doc_tree.Paragraph)
-			ctx.open_notes.remove(node.text)
-			
-# 			if isinstance( note_node, doc_tree.Note ):
-# 				note_node.add_subs( para_subs[0].iter_sub() )
-# 			elif isinstance( note_node, doc_tree.Link ):
-# 				ps = para_subs[0]
-# 				assert ps.len_sub() == 1
-# 				first_sub = ps.first_sub()
-# 				if isinstance(first_sub, doc_tree.Link):
-# 					note_node.url = first_sub.url
-# 					note_node.title = _as_text( ctx, first_sub)
-# 				
-# 			else:
-# 				raise Exception( "Unexpected note node: " + note_node )
-			
-			note_defn = doc_tree.NoteDefn(node.text, para_subs[0].iter_sub()  )
-			ctx.root_section.notes[node.text] = note_defn
-			return note_defn
-			
-		if node.class_ == '----':
-			para = doc_tree.BlockMark( doc_tree.MarkClass.minor_separator )
-		elif node.class_.startswith( '#' ):
-			# TODO: solve type issue
-			para = doc_tree.Section( len(node.class_), para_subs  )  # type:ignore
-		elif node.class_.startswith( '>' ):
-			para = doc_tree.Block( doc_tree.block_quote, para_subs )
-		elif node.class_.startswith( '-' ):
-			if isinstance( prev_in_section, doc_tree.List ):
-				para_list = prev_in_section
-				para = None
-			else:
-				para_list = doc_tree.List()
-				para = para_list
-				
-			list_item = doc_tree.ListItem( )
-			list_item.add_subs( para_subs )
-			para_list.add_sub( list_item )
-			
-		elif node.class_ in embed_map:
-			args = node.get_args()
-			num_args = len(args)
-			if num_args not in [1,2]:
-				raise Exception( f'{node.class_}-expect-1-2-arg', node.location.translate() )
-			assert num_args in [1,2]
-			para = doc_tree.Embed( embed_map[node.class_], args[0] )
-			if num_args == 2:
-				para.alt = args[1]
-			
-		else:
-			assert node.class_ == '', node.class_
-			
-			# TODO: probably all classes should be handled with annotations
-			blurb = node.get_annotation( "Blurb" )
-			aside = node.get_annotation( "Aside" )
-			promote = node.get_annotation( "Promote" )
-			custom = node.get_annotation( "Custom" )
-			if blurb != None:
-				para = doc_tree.Block( doc_tree.block_blurb, para_subs )
-			elif aside != None:
-				para = doc_tree.Block( doc_tree.block_aside, para_subs  )
-			elif promote != None:
-				para = doc_tree.Block( doc_tree.block_promote, para_subs )
-			elif custom != None:
-				para = doc_tree.Block( doc_tree.block_custom, para_subs, args=custom.args )
-			else:
-				assert len(para_subs) == 1
-				para = para_subs[0]
-
-		comment = node.get_annotation( "comment" )
-		if comment is not None and comment.node is not None:
-			assert para is not None
-			para.comment = _convert_blocks( ctx, _NodeIterator([comment.node]) )
-			
+_BlockTypeHandler = Callable[[_ConvertContext, _NodeIterator, Any], Optional[doc_tree.BlockNode]]
+
+# Converts the nodes, of each type, at the start of the iterator. Containers aren't here, as
+# `_BlockAppender.add_nodes` converts their children first.
+_block_type_handlers : Dict[tree_parser.NodeType, _BlockTypeHandler] = {
+	tree_parser.NodeType.raw: _convert_raw,
+	tree_parser.NodeType.block: _convert_block,
+	tree_parser.NodeType.matter: _skip_matter,
+}
+
+"""
+Converts a block, or container, node by its class, with its content already converted.
+"""
+def _convert_block_subs( ctx: _ConvertContext, node, para_subs: List[doc_tree.BlockNode], prev_in_section ):
+	annotations = _index_annotations( node ) if node.has_annotations() else {}
+	
+	convert_class = _block_class_handlers.get( node.class_ )
+	if convert_class is None and len(node.class_) > 0:
+		convert_class = _block_prefix_handlers.get( node.class_[0] )
+	assert convert_class is not None, node.class_
+	para = convert_class( ctx, node, para_subs, annotations, prev_in_section )
+	
+	if isinstance( para, doc_tree.NoteDefn ):
 		return para
 	
+	comment = annotations.get( "comment" )
+	if comment is not None and comment.node is not None:
+		assert para is not None
+		para.comment = _convert_blocks( ctx, _NodeIterator(( comment.node, )) )
+	
+	return para
+
+def _convert_note_defn( ctx: _ConvertContext, node, para_subs, annotations, prev_in_section ):
+	if not node.text in ctx.open_notes:
+		raise Exception( f'There is no reference to this note "{node.text}"' )
+	assert len(para_subs) == 1 and isinstance(para_subs[0], doc_tree.Paragraph)
+	ctx.open_notes.remove(node.text)
+	
+# 	if isinstance( note_node, doc_tree.Note ):
+# 		note_node.add_subs( para_subs[0].iter_sub() )
+# 	elif isinstance( note_node, doc_tree.Link ):
+# 		ps = para_subs[0]
+# 		assert ps.len_sub() == 1
+# 		first_sub = ps.first_sub()
+# 		if isinstance(first_sub, doc_tree.Link):
+# 			note_node.url = first_sub.url
+# 			note_node.title = _as_text( ctx, first_sub)
+# 		
+# 	else:
+# 		raise Exception( "Unexpected note node: " + note_node )
+	
+	note_defn = doc_tree.NoteDefn(node.text, para_subs[0].iter_sub()  )
+	ctx.root_section.notes[node.text] = note_defn
+	return note_defn
+
+def _convert_separator( ctx: _ConvertContext, node, para_subs, annotations, prev_in_section ):
+	return doc_tree.BlockMark( doc_tree.MarkClass.minor_separator )
+
+def _convert_section( ctx: _ConvertContext, node, para_subs, annotations, prev_in_section ):
+	# TODO: solve type issue
+	return doc_tree.Section( len(node.class_), para_subs  )  # type:ignore
+
+def _convert_quote( ctx: _ConvertContext, node, para_subs, annotations, prev_in_section ):
+	return doc_tree.Block( doc_tree.block_quote, para_subs )
+
+def _convert_list_item( ctx: _ConvertContext, node, para_subs, annotations, prev_in_section ):
+	# Consecutive items are added to the same list
+	if isinstance( prev_in_section, doc_tree.List ):
+		para_list = prev_in_section
+		para = None
+	else:
+		para_list = doc_tree.List()
+		para = para_list
+	
+	list_item = doc_tree.ListItem( )
+	list_item.add_subs( para_subs, trusted = True )
+	para_list.add_sub( list_item, trusted = True )
+	return para
+
+def _convert_embed( ctx: _ConvertContext, node, para_subs, annotations, prev_in_section ):
+	args = node.get_args()
+	num_args = len(args)
+	if num_args not in [1,2]:
+		raise Exception( f'{node.class_}-expect-1-2-arg', node.location.translate() )
+	assert num_args in [1,2]
+	para = doc_tree.Embed( embed_map[node.class_], args[0] )
+	if num_args == 2:
+		para.alt = args[1]
+	return para
+
+def _convert_plain( ctx: _ConvertContext, node, para_subs, annotations, prev_in_section ):
+	# TODO: probably all classes should be handled with annotations
+	for class_, convert_annotation in _annotation_block_handlers.items():
+		anno = annotations.get( class_ )
+		if anno is not None:
+			return convert_annotation( anno, para_subs )
+	
+	assert len(para_subs) == 1
+	return para_subs[0]
+
+_BlockClassHandler = Callable[[_ConvertContext, Any, List[doc_tree.BlockNode], Dict[str, tree_parser.Annotation], Any], Optional[doc_tree.BlockNode]]
+
+# Converts a block node, with its content already converted, by its class. A new block class
+# is added as an entry in one of these tables, an exact class taking precedence over a prefix.
+_block_class_handlers : Dict[str, _BlockClassHandler] = {
+	'': _convert_plain,
+	'----': _convert_separator,
+	**{ class_: _convert_embed for class_ in embed_map },
+}
+_block_prefix_handlers : Dict[str, _BlockClassHandler] = {
+	'^': _convert_note_defn,
+	'#': _convert_section,
+	'>': _convert_quote,
+	'-': _convert_list_item,
+}
+
+# The annotations which make a plain block into a block of a class, the first present applies
+_annotation_block_handlers : Dict[str, Callable[[tree_parser.Annotation, List[doc_tree.BlockNode]], doc_tree.BlockNode]] = {
+	'Blurb': lambda anno, para_subs: doc_tree.Block( doc_tree.block_blurb, para_subs ),
+	'Aside': lambda anno, para_subs: doc_tree.Block( doc_tree.block_aside, para_subs ),
+	'Promote': lambda anno, para_subs: doc_tree.Block( doc_tree.block_promote, para_subs ),
+	'Custom': lambda anno, para_subs: doc_tree.Block( doc_tree.block_custom, para_subs, args=anno.args ),
+}
+
 def _convert_inline( ctx, nodes_iter ) -> Sequence[doc_tree.Element]:
 	node = nodes_iter.next()
 	
@@ -244,42 +362,49 @@ def _convert_inline( ctx, nodes_iter ) -> Sequence[doc_tree.Element]:
 		return [ doc_tree.Text( node.text ) ]
 		
 	if node.type == tree_parser.NodeType.inline:
-		if node.class_ == '[':
-			return [ _convert_link( ctx, node, nodes_iter ) ]
-
-		if node.class_ == '^':
-			return [ _convert_note( ctx, node, nodes_iter ) ]
-			
-		if node.class_ == '*':
-			feature = doc_tree.feature_bold
-		elif node.class_ == '_':
-			feature = doc_tree.feature_italic
-		elif node.class_ == '`':
-			feature = doc_tree.feature_code
-		elif node.class_ == '$`':
-			feature = doc_tree.feature_latex
-		elif node.class_ == '(':
-			return [ doc_tree.Text( '(' + node.text + ')' ) ]
-		elif node.class_ == '::':
-			feature = doc_tree.feature_header
-		elif node.class_ == '{':
-			assert node.sub_is_empty()
-			return [ doc_tree.Token( node.get_args() ) ]
-			
-		else:
+		convert_class = _inline_class_handlers.get( node.class_ )
+		if convert_class is not None:
+			return [ convert_class( ctx, node, nodes_iter ) ]
+		
+		feature = _inline_features.get( node.class_ )
+		if feature is None:
 			raise Exception("Unknown feature", node.class_)
 			
 		block = doc_tree.Inline(feature)
-		block.add_subs( _convert_inlines(ctx, node) )
+		block.add_subs( _convert_inlines(ctx, node), trusted = True )
 		
 		if len(node.text) != 0:
 			assert len(block._sub) == 0
-			block.add_sub( doc_tree.Text( node.text ) )
+			block.add_sub( doc_tree.Text( node.text ), trusted = True )
 		
 		return [ block ]
 		
 	raise Exception("Unexpected node type" )
 
+def _convert_paren( ctx, node, nodes_iter ):
+	return doc_tree.Text( '(' + node.text + ')' )
+
+def _convert_token( ctx, node, nodes_iter ):
+	assert node.sub_is_empty()
+	return doc_tree.Token( node.get_args() )
+
+# Inline classes converted to an `Inline` of the feature, with the content of the node
+_inline_features : Dict[str, doc_tree.InlineFeature] = {
+	'*': doc_tree.feature_bold,
+	'_': doc_tree.feature_italic,
+	'`': doc_tree.feature_code,
+	'$`': doc_tree.feature_latex,
+	'::': doc_tree.feature_header,
+}
+
+# Inline classes converted otherwise, which may consume the following nodes
+_inline_class_handlers : Dict[str, Callable[[_ConvertContext, Any, _NodeIterator], doc_tree.Element]] = {
+	'[': lambda ctx, node, nodes_iter: _convert_link( ctx, node, nodes_iter ),
+	'^': lambda ctx, node, nodes_iter: _convert_note( ctx, node, nodes_iter ),
+	'(': _convert_paren,
+	'{': _convert_token,
+}
+
 def _convert_note( ctx, node, nodes_iter ):
 	if len(node.text) > 0:
 		if node.text in ctx.open_notes or node.text in ctx.root_section.notes:
@@ -319,7 +444,7 @@ def _convert_link( ctx: _ConvertContext, node: tree_parser.Node, nodes_iter: _No
 		note_id = None
 
 	block = doc_tree.Link(url=url, note_id=note_id)
-	block.add_subs( _convert_inlines(ctx, node) )
+	block.add_subs( _convert_inlines(ctx, node), trusted = True )
 
 	if note_id is not None:
 	 	ctx.open_notes.add(note_id)
@@ -1,7 +1,8 @@
 # Tree parsing
 from __future__ import annotations #type: ignore
 from typing import *
-from .source import SourceLocation
+from .source import Source, SourceLocation
+from . import validation
 
 from enum import Enum
 
@@ -39,21 +40,40 @@ class Annotation(object):
 	def args( self ) -> List[str]:
 		return self._args
 		
+	def copy( self, source : Source, shift : int ) -> Annotation:
+		return Annotation( self._class_, args = list( self._args ), 
+			node = self._node.copy( source, shift ) if self._node is not None else None )
 		
+		
+# Shared by all nodes without children or arguments, replaced by a list on the first addition
+_empty : Tuple[Any, ...] = ()
+
+
+"""
+	A node of the parse tree. Most nodes are text leaves, so nodes are kept compact: there is no
+	instance dictionary, nodes without children or arguments share one empty sentinel, and the
+	location is kept as an offset into the source, with the `SourceLocation` created on request.
+"""
 class Node(object):
+	__slots__ = ( '_sub', '_text', '_type', '_class_', '_attr', '_annotations', '_args', '_data',
+		'_source', '_offset', '_end' )
+		
 	def __init__(self, type: NodeType, loc : SourceLocation):
-		self._sub: List[Node] = []
+		self._sub: Sequence[Node] = _empty
 		self._text: str = ''
 		self._type: NodeType = type
 		self._class_: str = ''
 		self._attr: Optional[List['Node']] = None
 		self._annotations: Optional[List[Annotation]] = None
-		self._args: List[str] = []
+		self._args: Sequence[str] = _empty
 		self._data = None
-		self._loc: SourceLocation = loc
+		self._source: Source = loc.source
+		self._offset: int = loc.offset
+		# Offset just past the source text the node was parsed from
+		self._end: int = loc.offset
 		
 	def __str__( self ) -> str:
-		return f"{self._type}/{self._class_}:{self._loc.translate()} \"{self._text}\""
+		return f"{self._type}/{self._class_}:{self.location.translate()} \"{self._text}\""
 		
 	def validate_sub( self, sub ):
 		if self._type == NodeType.text:
@@ -72,6 +92,11 @@ class Node(object):
 			self._annotations = []
 		self._annotations += annotations[:]
 		
+	def prepend_annotations( self, annotations: List[Annotation] ):
+		if len(annotations) == 0:
+			return
+		self._annotations = annotations + (self._annotations or [])
+		
 	def get_annotation( self, class_: str ):
 		if self._annotations is None:
 			return None
@@ -81,17 +106,20 @@ class Node(object):
 		return None
 		
 	def add_args( self, args : List[str]):
-		self._args.extend( args )
+		if len(args) == 0:
+			return
+		self._args = [ *self._args, *args ]
 		
 	def get_args( self ) -> List[str]:
-		return self._args[:]
+		return list( self._args )
 		
 	def has_args( self ) -> bool:
 		return len(self._args) > 0
 		
 	def promote_to_container( self ) -> None:
-		first_child = Node( self._type, self._loc )
+		first_child = Node( self._type, self.location )
 		first_child._text = self._text
+		first_child._end = self._end
 		self._text = ''
 
 		first_child._sub = self._sub
@@ -100,23 +128,39 @@ class Node(object):
 		self._type = NodeType.container
 		
 	def remove_sub_at( self, index : int ) -> None:
-		del self._sub[index]
+		sub = list( self._sub )
+		del sub[index]
+		self._sub = sub
 		
 	"""
 		Splits this container node at the index, keeping children before the index in this container and those after in the returned container.
 	"""
 	def split_at( self, index : int ) -> Node:
-		container = Node( self._type, self._sub[index]._loc )
+		container = Node( self._type, self._sub[index].location )
 		container._sub = self._sub[index:]
+		container._end = self._end
 		self._sub = self._sub[:index]
+		self._end = self._sub[-1]._end if len(self._sub) > 0 else self._offset
 		return container
 		
-	def add_subs( self, subs : Sequence[Node] ) -> None:
-		for sub in subs:
-			self.add_sub( sub )
+	"""
+		@param trusted The children come from the parser, and are checked at the trusted
+			validation level
+	"""
+	def add_subs( self, subs : Sequence[Node], *, trusted : bool = False ) -> None:
+		for sub in validation.select_for_validation( subs, trusted ):
+			self.validate_sub( sub )
+		if len(subs) == 0:
+			return
+		if not isinstance( self._sub, list ):
+			self._sub = list( self._sub )
+		self._sub.extend( subs )
 			
-	def add_sub( self, sub : Node ) -> None:
-		self.validate_sub( sub )
+	def add_sub( self, sub : Node, *, trusted : bool = False ) -> None:
+		if validation.should_validate( trusted ):
+			self.validate_sub( sub )
+		if not isinstance( self._sub, list ):
+			self._sub = list( self._sub )
 		self._sub.append( sub )
 			
 	# As Python lacks a random access iterator, this returns a list view of the subs, it should not be modified
@@ -132,8 +176,52 @@ class Node(object):
 		return None
 		
 	@property
-	def location(self):
-		return self._loc
+	def location(self) -> SourceLocation:
+		return SourceLocation( self._source, self._offset )
+		
+	@property
+	def end_offset(self) -> int:
+		return self._end
+		
+	@end_offset.setter
+	def end_offset(self, end : int) -> None:
+		self._end = end
+		
+	def rebase( self, source : Source, shift : int ) -> None:
+		"""
+			Moves this node, and all nodes under it, to `source`, shifting their offsets by `shift`.
+			This is used to reuse nodes after the source text has been edited.
+		"""
+		self._source = source
+		self._offset += shift
+		self._end += shift
+		for sub in self._sub:
+			sub.rebase( source, shift )
+		for attr in self._attr or []:
+			attr.rebase( source, shift )
+		for anno in self._annotations or []:
+			if anno.node is not None:
+				anno.node.rebase( source, shift )
+		
+	def copy( self, source : Source, shift : int ) -> Node:
+		"""
+			A deep copy of this node, moved to `source` with its offsets shifted by `shift`, as
+			`rebase` does.
+		"""
+		node = Node( self._type, SourceLocation( source, self._offset + shift ) )
+		node._end = self._end + shift
+		node._text = self._text
+		node._class_ = self._class_
+		# Args are replaced, not modified, when added to
+		node._args = self._args
+		node._data = self._data
+		if len(self._sub) > 0:
+			node._sub = [ sub.copy( source, shift ) for sub in self._sub ]
+		if self._attr is not None:
+			node._attr = [ attr.copy( source, shift ) for attr in self._attr ]
+		if self._annotations is not None:
+			node._annotations = [ anno.copy( source, shift ) for anno in self._annotations ]
+		return node
 		
 	@property
 	def text(self):
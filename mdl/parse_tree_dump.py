@@ -1,4 +1,5 @@
 from .parse_tree import *
+from .flat_tree import FlatNode
 
 """
 	Debugging and test compliance utitlity.
@@ -7,7 +8,7 @@ class _dumper:
 	def __init__(self, ansi = False):
 		self.ansi = ansi
 		
-	def get( self, node : Node, indent : str = '' ) -> str:
+	def get( self, node : Union[Node, FlatNode], indent : str = '' ) -> str:
 		text = indent
 		header = node.type.name
 		if len(node.class_) > 0:
@@ -52,8 +53,8 @@ class _dumper:
 		return '\x1b[96m{}\x1b[m'.format(text)
 		
 		
-def dump( node : Node ) -> None:
+def dump( node : Union[Node, FlatNode] ) -> None:
 	print( _dumper( ansi = True ).get( node ) )
 	
-def get_dump( node : Node ) -> str:
+def get_dump( node : Union[Node, FlatNode] ) -> str:
 	return _dumper().get( node )
@@ -54,8 +54,18 @@ class Preparer(doc_tree.TransformCallback):
 		self.code_count = 0
 		self.document = document
 		
+		# Only the nodes which contain code blocks need be entered
+		self.code_ancestors : set[doc_tree.Node] = set()
+		root = document.root
+		if root is not None:
+			for code in root.find_all( doc_tree.Code ):
+				parent = root.parent_of( code )
+				while parent is not None and parent not in self.code_ancestors:
+					self.code_ancestors.add( parent )
+					parent = root.parent_of( parent )
+		
 	def enter(self, node : doc_tree.Node ) -> bool:
-		return True
+		return node in self.code_ancestors
 		
 	def exit(self, node : doc_tree.Node ) -> None:
 		return
@@ -80,19 +90,29 @@ class Preparer(doc_tree.TransformCallback):
 class Restorer(doc_tree.TransformCallback):
 	def __init__(self, document: Document) -> None:
 		self.document = document
+		# The sub-documents by name, in order, rather than searched for each embed
+		self.pending : dict[str, list[Document]] = {}
+		for sub in document.sub:
+			name = sub.meta.get( "name" )
+			if isinstance( name, str ):
+				self.pending.setdefault( name, [] ).append( sub )
+		self.restored : set[int] = set()
 		
 	def enter(self, node : doc_tree.Node ) -> bool:
 		return True
 		
 	def exit(self, node : doc_tree.Node ) -> None:
-		return
+		# Remove the restored sub-documents at once, once all are
+		if node is self.document.root:
+			self.document.sub = [ sub for sub in self.document.sub if id(sub) not in self.restored ]
 		
 	def transform(self, node: doc_tree.Node ) -> tuple[doc_tree.TransformType, doc_tree.Node]:
 		if isinstance( node, doc_tree.Embed ) and node.url.startswith( PREPARE_EMBED_PREFIX ):
-			restore_index = self.document.find_first_sub_index( lambda s: s.meta["name"] == node.url )
-			if restore_index is None:
+			candidates = self.pending.get( node.url )
+			if not candidates:
 				raise Exception(f"missing-sub:{node.url}")
-			restore = self.document.sub.pop(restore_index)
+			restore = candidates.pop(0)
+			self.restored.add( id(restore) )
 			
 			assert restore.root.len_sub() == 1
 			return doc_tree.TransformType.replace, restore.root.first_sub()
@@ -1,11 +1,83 @@
 import abc
+from typing import *
 
+# Writes a node, returning whether its children are to be visited
+NodeHandler = Callable[[Any, Any], bool]
+# A handler, or the name of the writer method which is the handler
+NodeHandlerRef = Union[NodeHandler, str]
+
+"""
+	Writers visit the document tree and write each node with the handler registered for its
+	type. A node of a type without a handler of its own uses that of its nearest base class
+	with one. The handler for each concrete node type is resolved once, and cached.
+
+	Handlers are registered on a writer class with `register_handler`, and are inherited by
+	its subclasses, which may replace them. Other modules may thus add writing of new node
+	types to an existing writer. A handler registered by method name is looked up on the
+	writer's own class, thus a subclass overriding that method replaces it as well.
+"""
 class Writer(abc.ABC):
+	_handlers : ClassVar[Dict[type, NodeHandlerRef]] = {}
+	_resolved : ClassVar[Dict[type, NodeHandler]] = {}
+	# The message of the exception raised for a node without a handler
+	_unknown_node_message = "unknown-node-type"
+
+	def __init_subclass__(cls, **kwargs):
+		super().__init_subclass__(**kwargs)
+		cls._handlers = {}
+		cls._resolved = {}
+
 	def __init__(self):
 		pass
-		
+
 	@abc.abstractmethod
-	def render(self, doc):
+	def render(self, doc) -> str:
 		pass
 
-		
+	def render_to(self, doc, stream : TextIO) -> None:
+		"""
+			Renders as `render`, writing the output to `stream`. Writers which can, override this
+			to write the output as it's produced, rather than holding all of it.
+		"""
+		stream.write( self.render( doc ) )
+
+	@classmethod
+	def register_handler(cls, node_type : type, handler : NodeHandlerRef) -> None:
+		"""
+			@param handler Called with the writer and the node, or the name of a method of the
+				writer called with the node
+		"""
+		cls._handlers[node_type] = handler
+
+		# The resolution of this class, and those deriving from it, may have changed
+		pending : List[type] = [cls]
+		while len(pending) > 0:
+			writer_type = pending.pop()
+			writer_type._resolved.clear() # type: ignore[attr-defined]
+			pending.extend( writer_type.__subclasses__() )
+
+	@classmethod
+	def register_handlers(cls, handlers : Mapping[type, NodeHandlerRef]) -> None:
+		for node_type, handler in handlers.items():
+			cls.register_handler( node_type, handler )
+
+	@classmethod
+	def _resolve_handler(cls, node_type : type) -> Optional[NodeHandler]:
+		for base_type in node_type.__mro__:
+			for writer_type in cls.__mro__:
+				handler = writer_type.__dict__.get( '_handlers', {} ).get( base_type )
+				if isinstance( handler, str ):
+					return cast(NodeHandler, getattr( cls, handler ))
+				if handler is not None:
+					return cast(NodeHandler, handler)
+		return None
+
+	def _write_node(self, node) -> bool:
+		node_type = type(node)
+		handler = self._resolved.get( node_type )
+		if handler is None:
+			handler = self._resolve_handler( node_type )
+			if handler is None:
+				raise Exception( self._unknown_node_message, node )
+			self._resolved[node_type] = handler
+		return handler( self, node )
@@ -2,7 +2,7 @@ __all__ = [ 'Source', 'SourceLocation' ]
 
 from typing import *
 import regex as re #type: ignore
-import sys
+import sys, bisect, mmap, os
 
 re.DEFAULT_VERSION = re.VERSION1
 
@@ -14,6 +14,44 @@ _syntax_empty_line = re.compile( r'[\p{Space_Separator}\t]*$', re.MULTILINE )
 _syntax_line_ends = re.compile( r'[\n\r]' )
 
 
+_token_patterns : Dict[Tuple[str,...], re.Pattern] = {}
+def _get_token_pattern( exclude : Sequence[str] ) -> re.Pattern:
+	key = tuple( exclude )
+	pattern = _token_patterns.get( key )
+	if pattern is None:
+		pattern = re.compile( r'[^\s' + ''.join( re.escape( c ) for c in exclude ) + r']*' )
+		_token_patterns[key] = pattern
+	return pattern
+	
+_string_stop_patterns : Dict[str, re.Pattern] = {}
+def _get_string_stop_pattern( close_char : str ) -> re.Pattern:
+	pattern = _string_stop_patterns.get( close_char )
+	if pattern is None:
+		pattern = re.compile( r'\\|' + re.escape( close_char ) )
+		_string_stop_patterns[close_char] = pattern
+	return pattern
+	
+def _find_or_end( text : str, sub : str, start : int, end : int ) -> int:
+	at = text.find( sub, start, end )
+	return end if at == -1 else at
+
+def _decode_mapped( in_file : BinaryIO ) -> str:
+	# mmap refuses to map an empty file
+	if os.fstat( in_file.fileno() ).st_size == 0:
+		return ''
+		
+	with mmap.mmap( in_file.fileno(), 0, access = mmap.ACCESS_READ ) as mapped:
+		with memoryview( mapped ) as view:
+			return _decode( view )
+			
+def _decode( data : bytes | memoryview ) -> str:
+	text = str( data, 'utf-8' )
+	# Match the universal newline translation of reading in text mode
+	if '\r' in text:
+		text = text.replace( '\r\n', '\n' ).replace( '\r', '\n' )
+	return text
+	
+
 class SourceLocation(NamedTuple):
 	source: 'Source'
 	offset: int
@@ -26,28 +64,16 @@ class SourceLocation(NamedTuple):
 		)
 		
 	def line_context(self) -> str:
-		start = self.offset
-		back_lines = 2
-		while start > 0:
-			c = self.source._text[start]
-			if c == '\n':
-				back_lines -=1
-				if back_lines == 0:
-					# don't start with linefeed
-					start += 1
-					break
-			start -=1
-			
-		end = start
-		lines = 4
-		while end < len(self.source._text):
-			c = self.source._text[end]
-			if c == '\n':
-				lines -=1
-				if lines == 0:
-					break
-			end += 1
-
+		"""
+			The text surrounding the location: the line before it, its own line, and the two
+			lines following it.
+		"""
+		starts = self.source._get_line_starts()
+		line = self.source._line_index(self.offset)
+		first = max(line - 1, 0)
+		last = first + 4
+		start = starts[first]
+		end = starts[last] - 1 if last < len(starts) else len(self.source._text)
 		return self.source._text[start:end]
 		
 	def line_at(self) -> int:
@@ -57,30 +83,14 @@ class SourceLocation(NamedTuple):
 		# some cases, but this is usually for visual output, so uncertain...
 		# q = min(self.offset + self.source._base_offset, len(self.source._text)-self.source._base_offset)
 		q = min(self.offset, len(self.source._text))
-		line = 1
-		while q > 1:
-			q -= 1
-			c = self.source._text[q]
-			if c == '\n':
-				line += 1
-				
-		return line
+		return self.source._line_index(q) + 1
 	
 	def col_at(self, tab_size = 4) -> int:
 		# q = min(self.offset + self.source._base_offset, len(self.source._text)-self.source._base_offset)
 		q = min(self.offset, len(self.source._text))
-		col = 1
-		while q > 1:
-			q -= 1
-			c = self.source._text[q]
-			if c == '\n':
-				break
-			if c == '\t':
-				col += tab_size
-			else:
-				col += 1
-		
-		return col
+		start = self.source._get_line_starts()[self.source._line_index(q)]
+		tabs = self.source._text.count('\t', start, q)
+		return 1 + (q - start) + tabs * (tab_size - 1)
 		
 	
 class Source(object):
@@ -94,6 +104,8 @@ class Source(object):
 		self._size = len(text)
 		self._path = path
 		self._base_offset = base_offset
+		# Offsets at which each line begins, built on first use by location translation
+		self._line_starts : Optional[List[int]] = None
 
 	@classmethod 
 	def with_text( class_, text : str, base_location : Optional[SourceLocation] = None ) -> 'Source':
@@ -106,9 +118,19 @@ class Source(object):
 		return src
 		
 	@classmethod
-	def with_filename( class_, filename : str ) -> 'Source':
-		in_file = open( filename, 'r', encoding = 'utf-8' )
-		in_text = in_file.read()
+	def with_filename( class_, filename : str, data : Optional[bytes] = None ) -> 'Source':
+		"""
+			Maps the file and decodes the text directly from the mapping. No intermediate
+			bytes copy of the file is held next to the decoded text.
+			
+			@param data The bytes of the file, if they've already been read, which are decoded
+				instead of reading the file again
+		"""
+		if data is not None:
+			in_text = _decode( data )
+		else:
+			with open( filename, 'rb' ) as in_file:
+				in_text = _decode_mapped( in_file )
 		src = Source(Source._private(), in_text, path=filename)
 		return src
 		
@@ -170,13 +192,36 @@ class Source(object):
 		return None, None
 	
 	def map_position(self, where : int) -> Tuple[int,int]:
-		lines = self._text.count( '\n', 0, self._at )
-		last_line = self._text.rfind( '\n', 0, self._at )
-		return ( lines, self._at - last_line )
+		line = self._line_index( self._at )
+		return ( line, self._at - self._get_line_starts()[line] + 1 )
+		
+	def _get_line_starts(self) -> List[int]:
+		if self._line_starts is None:
+			starts = [0]
+			at = self._text.find( '\n' )
+			while at != -1:
+				starts.append( at + 1 )
+				at = self._text.find( '\n', at + 1 )
+			self._line_starts = starts
+		return self._line_starts
+		
+	def _line_index(self, offset : int) -> int:
+		"""
+			The zero-based index of the line containing `offset`.
+		"""
+		return bisect.bisect_right( self._get_line_starts(), offset ) - 1
 		
 	@property
 	def position(self) -> int:
 		return self._at
+		
+	@property
+	def text(self) -> str:
+		return self._text
+		
+	def skip_to(self, position : int) -> None:
+		assert position >= self._at
+		self._at = position
 
 	def match_indent(self, indent : str) -> Tuple[bool, str]:
 		"""
@@ -208,62 +253,72 @@ class Source(object):
 		
 		
 	def parse_token( self, exclude : List[str] ) -> str:
-		text = ''
-		while not self.is_at_end():
-			c = self.peek_char()
-			if _syntax_skip_space.match(c) or c in exclude:
-				break
-			text += self.next_char()
-			
-		return text
+		return self.match( _get_token_pattern( exclude ) ).group(0)
 		
 	def parse_string( self, close_char : str ) -> str:
-		text = ''
+		text : List[str] = []
+		stop_pattern = _get_string_stop_pattern( close_char )
 		
 		while not self.is_at_end():
-			c = self.next_char()
-			if c == '\\':
-				c = self.next_char()
-				has = True
-			elif c == close_char:
+			m = stop_pattern.search( self._text, self._at, self._size )
+			if m is None:
+				text.append( self._text[self._at:self._size] )
+				self._at = self._size
 				break
-			
-			text += c
 				
-		return text
+			text.append( self._text[self._at:m.start()] )
+			self._at = m.end()
+			if m.group(0) != '\\':
+				break
+			text.append( self.next_char() )
+				
+		return ''.join( text )
 
 	def parse_string_to( self, *, 
 		char : Optional[str] = None, consume_terminal : bool = False,
 		re = None,
 	) -> str:
-		text = ''
+		"""
+			Parses text up to the terminal `char`, or a match of `re`, resolving backslash escapes.
+			The plain text between escapes and terminals is taken in whole slices.
+		"""
+		text : List[str] = []
+		# The next position of each stop, only searched again once the scan has passed it
+		re_match = None
+		re_at = -1
+		char_at = -1
+		escape_at = -1
 		
 		while not self.is_at_end():
-			if consume_terminal:
-				if re is not None:
-					if self.match(re):
-						break
-				c = self.next_char()
-				if c == char:
-					break
-					
-			else:
-				if re is not None:
-					if self.peek_match(re):
-						break
-				c = self.peek_char()
-				if c == char:
-					break
-					
-				c = self.next_char()
+			at = self._at
+			if re is not None and re_at < at:
+				re_match = re.search( self._text, at, self._size )
+				re_at = self._size if re_match is None else re_match.start()
+			if char is not None and char_at < at:
+				char_at = _find_or_end( self._text, char, at, self._size )
+			if escape_at < at:
+				escape_at = _find_or_end( self._text, '\\', at, self._size )
 				
-			if c == '\\':
-				c = self.next_char()
-				has = True
-			
-			text += c
+			stop = min( re_at if re is not None else self._size, char_at if char is not None else self._size, escape_at )
+			text.append( self._text[at:stop] )
+			self._at = stop
+			if self.is_at_end():
+				break
+				
+			if re_match is not None and stop == re_at:
+				if consume_terminal:
+					self._at = re_match.end()
+				break
+				
+			if stop == char_at:
+				if consume_terminal:
+					self._at += 1
+				break
 				
-		return text
+			self._at += 1
+			text.append( self.next_char() )
+				
+		return ''.join( text )
 		
 	
 	@property
@@ -285,11 +340,11 @@ class ParseException(Exception):
 		self._code = code
 		self._location = location
 		self._message = message
+		# The location is only translated if the message is actually formatted
+		super().__init__(code)
 		
-		loc = location.translate()
-		msg = f'{loc[0]}:{loc[1]},{loc[2]}:{":".join([code] + message)}'
-		super().__init__(msg)
-
+	def __str__(self) -> str:
+		return self.format_line()
 			
 	@property
 	def code(self) -> str:
@@ -0,0 +1,110 @@
+# Text replacements applied while parsing text
+__all__ = [ 'TextReplacer' ]
+
+from typing import *
+import regex as re # type: ignore
+
+
+class _TrieNode:
+	__slots__ = ( 'next', 'value' )
+
+	def __init__(self):
+		self.next : Dict[str, _TrieNode] = {}
+		self.value : Optional[str] = None
+
+
+"""
+	A table of literal text replacements stored as a trie. Matching walks the trie from a
+	starting position, so the cost of a match depends on the length of the keys, not on the
+	number of entries. Where several keys match at the same position the longest one wins.
+"""
+class TextReplacer:
+	def __init__(self):
+		self._root = _TrieNode()
+		self._lead_chars : Set[str] = set()
+		self._lead_regex : Optional[re.Pattern] = None
+
+	def add( self, src : str, dst : str ) -> None:
+		assert len(src) > 0
+		node = self._root
+		for c in src:
+			next_node = node.next.get( c )
+			if next_node is None:
+				next_node = _TrieNode()
+				node.next[c] = next_node
+			node = next_node
+
+		assert node.value is None, src
+		node.value = dst
+
+		if src[0] not in self._lead_chars:
+			self._lead_chars.add( src[0] )
+			self._lead_regex = None
+
+	def __contains__( self, src : str ) -> bool:
+		node = self._root
+		for c in src:
+			next_node = node.next.get( c )
+			if next_node is None:
+				return False
+			node = next_node
+		return node.value is not None
+
+	def match_at( self, text : str, at : int ) -> Optional[Tuple[int, str]]:
+		"""
+			@return the end of the longest key matching at `at`, and its replacement, or None
+				if no key matches there
+		"""
+		node = self._root
+		found = None
+		end = len(text)
+		while at < end:
+			next_node = node.next.get( text[at] )
+			if next_node is None:
+				break
+			node = next_node
+			at += 1
+			if node.value is not None:
+				found = (at, node.value)
+
+		return found
+
+	def replace_run( self, text : str, start : int, end : int ) -> Tuple[str, int]:
+		"""
+			Replaces all keys starting in text[start:end], scanning left to right. A key starting
+			inside the run may extend beyond `end`.
+
+			@return
+				[0] the text of the run with replacements applied
+				[1] where the run ends, which is past `end` if the last key extended beyond it
+		"""
+		if len(self._lead_chars) == 0:
+			return text[start:end], end
+
+		lead_regex = self._get_lead_regex()
+		out : List[str] = []
+		at = start
+		scan = start
+		while scan < end:
+			m = lead_regex.search( text, scan, end )
+			if m is None:
+				break
+
+			found = self.match_at( text, m.start() )
+			if found is None:
+				scan = m.start() + 1
+				continue
+
+			out.append( text[at:m.start()] )
+			out.append( found[1] )
+			at = scan = found[0]
+
+		if at < end:
+			out.append( text[at:end] )
+			at = end
+		return ''.join( out ), at
+
+	def _get_lead_regex( self ) -> re.Pattern:
+		if self._lead_regex is None:
+			self._lead_regex = re.compile( '[' + ''.join( re.escape(c) for c in sorted(self._lead_chars) ) + ']' )
+		return self._lead_regex
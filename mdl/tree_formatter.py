@@ -2,7 +2,6 @@ __all__ = ['TreeFormatter']
 
 from typing import *
 from enum import Enum, auto
-import io
 
 class TFType(Enum):
 	section = auto()
@@ -11,20 +10,39 @@ class TFType(Enum):
 TFPair = Tuple[TFType,Optional[str]]
 TFCapture = Callable[[str],str]
 
+"""
+	The text written within a context is the chunks from `start` onward, until it ends.
+"""
 class Context:
-	def __init__(self):
-		self.body = io.StringIO()
+	__slots__ = ( 'start', 'post', 'capture', 'indent' )
+	
+	def __init__(self, start : int):
+		self.start = start
 		self.post : List[TFPair] = []
 		self.capture : Optional[TFCapture] = None
 		self.indent : str | None = None
 		
+"""
+	All text is written to one list of chunks. A context marks where its text starts in the
+	list, and its text is only joined into a string if a capture function needs it. Thus text
+	isn't copied for each context it's nested in.
+	
+	With `stream_to` the chunks are instead written to a stream as contexts end, whenever no
+	capture is pending, since no later output can change them.
+"""
 class TreeFormatter:
+	# The number of chunks collected before they're written to the stream
+	_flush_chunks = 4096
+	
 	def __init__(self):
-		self._cur_context = Context()
+		self._chunks : List[str] = []
+		self._cur_context = Context( 0 )
 		self._context : List[Context] = [ self._cur_context ]
+		self._stream : Optional[TextIO] = None
+		self._captures = 0
 		
 	def section(self, open : str, close : Optional[str] ):
-		self._cur_context.body.write( open )
+		self._chunks.append( open )
 		self._cur_context.post.append( (TFType.section, close) )
 		
 	#TODO: merge with end_context / remove
@@ -32,26 +50,30 @@ class TreeFormatter:
 		s = self._cur_context.post.pop()
 		assert s[0] == TFType.section
 		if s[1] is not None:
-			self._cur_context.body.write( s[1] )
+			self._chunks.append( s[1] )
 			
 	def write( self, text : str ):
-		self._cur_context.body.write( text )
+		self._chunks.append( text )
 
 	def open_context( self ):
-		self._cur_context = Context()
+		self._cur_context = Context( len(self._chunks) )
 		self._context.append( self._cur_context )
 	
 	def end_context( self ):
 		ctx = self._context.pop()
 		for item in ctx.post:
 			if item[1] is not None:
-				ctx.body.write(item[1])
+				self._chunks.append(item[1])
 				
 		self._cur_context = self._context[-1]
-		text = ctx.body.getvalue()
 		if ctx.capture is not None:
-			text = ctx.capture(text)
-		self._cur_context.body.write( text )
+			text = ctx.capture( self._join_from( ctx.start ) )
+			self._chunks.append( text )
+			self._captures -= 1
+			
+		if self._stream is not None and self._captures == 0 and \
+			len(self._chunks) >= self._flush_chunks:
+			self.flush()
 		
 	def set_indent( self, indent: str ): 
 		self._context[-1].indent = indent
@@ -59,8 +81,36 @@ class TreeFormatter:
 	def capture(self, render : Callable[[str],str]):
 		assert self._cur_context.capture is None
 		self._cur_context.capture = render
+		self._captures += 1
+		
+	def stream_to( self, stream : TextIO ) -> None:
+		"""
+			Writes the output to `stream`, rather than collecting it as the `value`. `flush` must be
+			called once all the output is written.
+		"""
+		self._stream = stream
+		self.flush()
+		
+	def flush( self ) -> None:
+		assert self._stream is not None
+		assert self._captures == 0
+		self._stream.write( ''.join( self._chunks ) )
+		self._chunks.clear()
+		for ctx in self._context:
+			ctx.start = 0
 		
+	def _join_from( self, start : int ) -> str:
+		"""
+			Removes the chunks from `start` onward, returning them joined
+		"""
+		text = ''.join( self._chunks[start:] )
+		del self._chunks[start:]
+		return text
 		
 	@property
 	def value(self) -> str:
-		return self._cur_context.body.getvalue()
+		assert self._stream is None
+		# Kept joined, as the value may be asked for again
+		text = self._join_from( self._cur_context.start )
+		self._chunks.append( text )
+		return text
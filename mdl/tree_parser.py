@@ -4,9 +4,14 @@ import regex as re # type: ignore
 from typing import *
 from abc import abstractmethod
 from enum import Enum, auto
+import concurrent.futures, hashlib, os
 
-from .source import Source, SourceLocation
+from .source import Source, SourceLocation, ParseException
+from .text_replace import TextReplacer
 from .parse_tree import *
+from .flat_tree import FlatTree
+from .block_memo import BlockMemo
+from .doc_cache import get_code_fingerprint
 
 _syntax_empty_line = re.compile( r'[\p{Space_Separator}\t]*$', re.MULTILINE )
 _syntax_inline_header = re.compile( r'::' )
@@ -22,9 +27,12 @@ class BlockLevelBuilder:
 		self._indent = indent
 		
 	def append_annotation( self, anno : Annotation ) -> None:
+		if anno.node is not None:
+			anno.node.end_offset = self.source.position
 		self._annotations.append( anno )
 		
 	def append_block( self, block ) -> None:
+		block.end_offset = self.source.position
 		block.add_annotations( self._annotations )
 		self._annotations = []
 		self._blocks.append( block )
@@ -51,8 +59,32 @@ class BlockLevelMatcher(Protocol):
 	@abstractmethod
 	def process( self, builder : BlockLevelBuilder, match : re.Match ):
 		raise NotImplementedError()
-	
-	
+		
+	def get_lead_chars( self ) -> Optional[str]:
+		"""
+			The characters a line must start with for the match regex to match it. The parser
+			only tries the matcher on lines starting with one of these. None means the matcher is
+			tried on every line.
+		"""
+		return None
+		
+	def get_config( self ) -> Optional[Hashable]:
+		"""
+			Identifies how the matcher is configured. Matchers of the same type with equal
+			configurations must match the same way, thus may share a grammar, and the parses
+			memoized with it. Its `repr` must be the same in every process, such as a tuple of
+			strings and numbers. None means the matcher can't be identified, thus gets a grammar
+			of its own, with which parses aren't memoized.
+		"""
+		return None
+		
+		
+# A matcher without any configuration, all instances of which match the same way
+class _FixedMatcher(BlockLevelMatcher):
+	def get_config( self ) -> Optional[Hashable]:
+		return ()
+		
+		
 # A feature may have any regex opening match, but requires a single character terminal
 class FeatureParse():
 	class ContentType(Enum):
@@ -113,11 +145,14 @@ class FeatureParse():
 		return self.content == self.ContentType.token
 	
 
-class BLMAnnotation(BlockLevelMatcher):
+class BLMAnnotation(_FixedMatcher):
 	pattern = re.compile( r'@(\p{L}+)(\(([^\)]*)\))?' ) # cheap args parsing for now
 	def get_match_regex( self ) -> re.Pattern:
 		return self.pattern
 		
+	def get_lead_chars( self ) -> Optional[str]:
+		return '@'
+		
 	def process( self, builder : BlockLevelBuilder, match : re.Match ):
 		args_group = match.group(3)
 		args: List[str] = []
@@ -126,40 +161,49 @@ class BLMAnnotation(BlockLevelMatcher):
 		builder.append_annotation( Annotation( match.group(1), args=args ) )
 		
 
-class BLMLine(BlockLevelMatcher):
+class BLMLine(_FixedMatcher):
 	pattern = re.compile( r'(#+|-)\s*' )
 	def get_match_regex( self ) -> re.Pattern:
 		return self.pattern
 		
+	def get_lead_chars( self ) -> Optional[str]:
+		return '#-'
+		
 	def process( self, builder : BlockLevelBuilder, match : re.Match ):
 		class_ = match.group(1)
 		line = Node(NodeType.block, builder.location)
 		line.class_ = class_
-		line.add_subs( builder.parse_line() )
+		line.add_subs( builder.parse_line(), trusted = True )
 		builder.append_block( line )
 
 		
-class BLMComment(BlockLevelMatcher):
+class BLMComment(_FixedMatcher):
 	# // must be first, as it appears to be doing non-greedy matching
 	pattern = re.compile( r'(//|/)\s*' )
 	def get_match_regex( self ) -> re.Pattern:
 		return self.pattern
 		
+	def get_lead_chars( self ) -> Optional[str]:
+		return '/'
+		
 	def process( self, builder : BlockLevelBuilder, match : re.Match ):
 		if match.group(1) == '//':
 			para = builder.parse_para()
 			builder.append_annotation( Annotation( 'comment', node=para ) )
 		else:
 			line = Node(NodeType.block, builder.location)
-			line.add_subs( builder.parse_line() )
+			line.add_subs( builder.parse_line(), trusted = True )
 			builder.append_annotation( Annotation( 'comment', node=line) )
 			
 
-class BLMSeparator(BlockLevelMatcher):
+class BLMSeparator(_FixedMatcher):
 	pattern = re.compile( r'----[^$\s]*' )
 	def get_match_regex( self ) -> re.Pattern:
 		return self.pattern
 		
+	def get_lead_chars( self ) -> Optional[str]:
+		return '-'
+		
 	def process( self, builder : BlockLevelBuilder, match : re.Match ):
 		sep = Node(NodeType.block, builder.location)
 		_ = builder.parse_line() # TODO: don't allow anything
@@ -167,11 +211,14 @@ class BLMSeparator(BlockLevelMatcher):
 		builder.append_block( sep )
 		
 
-class BLMTag(BlockLevelMatcher):
+class BLMTag(_FixedMatcher):
 	pattern = re.compile( r'{%\s+(\p{L}+)\s' )
 	def get_match_regex( self ) -> re.Pattern:
 		return self.pattern
 		
+	def get_lead_chars( self ) -> Optional[str]:
+		return '{'
+		
 	def process( self, builder : BlockLevelBuilder, match : re.Match ):
 		para = Node(NodeType.block, builder.location)
 		para.class_ = match.group(1)
@@ -181,11 +228,14 @@ class BLMTag(BlockLevelMatcher):
 		builder.append_block( para )
 
 		
-class BLMBlock(BlockLevelMatcher):
+class BLMBlock(_FixedMatcher):
 	pattern = re.compile( r'(>|>>)\s*' )
 	def get_match_regex( self ) -> re.Pattern:
 		return self.pattern
 		
+	def get_lead_chars( self ) -> Optional[str]:
+		return '>'
+		
 	def process( self, builder : BlockLevelBuilder, match : re.Match ):
 		class_ = match.group(1)
 		para = builder.parse_para()
@@ -193,11 +243,14 @@ class BLMBlock(BlockLevelMatcher):
 		builder.append_block( para )
 	
 
-class BLMFootnote(BlockLevelMatcher):
+class BLMFootnote(_FixedMatcher):
 	pattern = re.compile( r'\^([\p{L}\p{N}-_]+)\s+' )
 	def get_match_regex( self ) -> re.Pattern:
 		return self.pattern
 		
+	def get_lead_chars( self ) -> Optional[str]:
+		return '^'
+		
 	def process( self, builder : BlockLevelBuilder, match : re.Match ):
 		para = builder.parse_para()
 		para.class_ = '^'
@@ -205,13 +258,16 @@ class BLMFootnote(BlockLevelMatcher):
 		builder.append_block( para )
 		
 		
-class BLMRaw(BlockLevelMatcher):
+class BLMRaw(_FixedMatcher):
 	pattern_open = re.compile( r'(```)' )
 	pattern_close = re.compile( r'(^```)', re.MULTILINE )
 	pattern_rest_line = re.compile( r'(.*)$', re.MULTILINE )
 	def get_match_regex( self ) -> re.Pattern:
 		return self.pattern_open
 		
+	def get_lead_chars( self ) -> Optional[str]:
+		return '`'
+		
 	def process( self, builder : BlockLevelBuilder, match : re.Match ):
 		raw = Node(NodeType.raw, builder.location)
 		line_match = builder.source.match(self.pattern_rest_line)
@@ -224,11 +280,14 @@ class BLMRaw(BlockLevelMatcher):
 		builder.append_block( raw )
 		
 
-class BLMMatter(BlockLevelMatcher):
+class BLMMatter(_FixedMatcher):
 	pattern_open = re.compile( r'(^\+\+\+\s*)', re.MULTILINE ) 
 	pattern_end = re.compile( r'(^\+\+\+\s*$)', re.MULTILINE )
 	def get_match_regex( self ) -> re.Pattern:
 		return self.pattern_open
+		
+	def get_lead_chars( self ) -> Optional[str]:
+		return '+'
 	
 	def process( self, builder : BlockLevelBuilder, match : re.Match ):
 		matter = Node(NodeType.matter, builder.location)
@@ -238,59 +297,260 @@ class BLMMatter(BlockLevelMatcher):
 		builder.append_block( matter )
 	
 	
-class TreeParser:
-	def __init__(self):
-		self._syntax_feature_map : Dict[str,FeatureParse] = {}
-		self._syntax_feature : Optional[re.Pattern] = None
+def _matcher_config( blm : BlockLevelMatcher ) -> Optional[Hashable]:
+	# Matchers may implement the protocol without deriving from it
+	get_config = getattr( blm, 'get_config', None )
+	return get_config() if get_config is not None else None
+	
+"""
+	The compiled syntax used by the parser. A grammar is not modified once created, adding
+	replacements or matchers derives a new grammar. Derived grammars are cached on the grammar
+	they came from, thus all parsers configured the same way in a process share one grammar.
+"""
+class Grammar:
+	_default : Optional[Grammar] = None
+	
+	def __init__(self, *, 
+		text_replace : Dict[str,str], 
+		block_level_matchers : Sequence[BlockLevelMatcher],
+		features : Dict[str,FeatureParse],
+	):
+		self._text_replace_map = dict( text_replace )
+		self._text_replace = TextReplacer()
+		for src, dst in text_replace.items():
+			self._text_replace.add( src, dst )
+		
+		self._block_level_matchers = tuple( block_level_matchers )
+		self._init_blm_dispatch()
+		
+		self._syntax_feature_map = dict( features )
+		s = "|".join([re.escape(tok) for tok in self._syntax_feature_map.keys()])
+		self._syntax_feature = re.compile(s)
+		
+		# Filled in on first use
+		self._plain_run_regex : Dict[str, re.Pattern] = {}
+		self._derived : Dict[Tuple[Any, ...], Grammar] = {}
+		self._fingerprint : Optional[bytes] = None
+		self._no_fingerprint = False
+		
+	@classmethod
+	def default( class_ ) -> Grammar:
+		if class_._default is None:
+			class_._default = Grammar(
+				text_replace = {
+					'--': '—',
+					'...': '…',
+					# a test to ensure this plugin support would work
+					':)': '☺',
+				},
+				block_level_matchers = [
+					BLMAnnotation(),
+					BLMSeparator(),
+					BLMLine(),
+					BLMComment(),
+					BLMTag(),
+					BLMBlock(),
+					BLMFootnote(),
+					BLMRaw(),
+					BLMMatter(),
+				],
+				features = {
+					'*': FeatureParse.open_close('*','*'),
+					'_': FeatureParse.open_close('_','_'),
+					'$`': FeatureParse.noescape_raw('$`','`'),
+					'`': FeatureParse.back_raw('`','`'),
+					'[': FeatureParse.open_close('[',']'),
+					'(': FeatureParse.back_raw('(',')'),
+					'{': FeatureParse.token('{','}'),
+				},
+			)
+		return class_._default
+		
+	def with_text_replace( self, reps : Dict[str,str] ) -> Grammar:
+		key = ( 'text_replace', tuple( reps.items() ) )
+		grammar = self._derived.get( key )
+		if grammar is None:
+			for src in reps.keys():
+				assert src not in self._text_replace
+			grammar = Grammar(
+				text_replace = { **self._text_replace_map, **reps },
+				block_level_matchers = self._block_level_matchers,
+				features = self._syntax_feature_map,
+			)
+			self._derived[key] = grammar
+		return grammar
+		
+	def with_block_level_matcher( self, blm : BlockLevelMatcher ) -> Grammar:
+		"""
+			The grammar is cached by the matcher's type and configuration, thus it holds the first
+			of the equally configured matchers added. A matcher without a configuration gets a
+			new grammar.
+		"""
+		config = _matcher_config( blm )
+		key = ( 'block_level_matcher', type(blm), config )
+		grammar = self._derived.get( key ) if config is not None else None
+		if grammar is None:
+			grammar = Grammar(
+				text_replace = self._text_replace_map,
+				block_level_matchers = self._block_level_matchers + ( blm, ),
+				features = self._syntax_feature_map,
+			)
+			if config is not None:
+				self._derived[key] = grammar
+		return grammar
+		
+	@property
+	def text_replace( self ) -> TextReplacer:
+		return self._text_replace
+		
+	@property
+	def fingerprint( self ) -> Optional[bytes]:
+		"""
+			Identifies the syntax, and the code parsing it, the same way in every process. Used in
+			the keys of caches of parse results. None if a matcher has no configuration, thus
+			the syntax can't be identified, and parses must not be cached.
+		"""
+		if self._fingerprint is None and not self._no_fingerprint:
+			digest = hashlib.sha256( get_code_fingerprint() )
+			for src, dst in sorted( self._text_replace_map.items() ):
+				digest.update( repr( ( src, dst ) ).encode( 'utf-8' ) )
+			for blm in self._block_level_matchers:
+				config = _matcher_config( blm )
+				if config is None:
+					self._no_fingerprint = True
+					return None
+				digest.update( f'{type(blm).__module__}.{type(blm).__qualname__}{config!r}'.encode( 'utf-8' ) )
+			for key, feature in sorted( self._syntax_feature_map.items() ):
+				digest.update( repr( ( key, feature.open_pattern, feature.close_char, feature.content.name ) ).encode( 'utf-8' ) )
+			self._fingerprint = digest.digest()
+		return self._fingerprint
+		
+	@property
+	def feature_map( self ) -> Mapping[str,FeatureParse]:
+		return self._syntax_feature_map
+		
+	@property
+	def feature_regex( self ) -> re.Pattern:
+		return self._syntax_feature
+		
+	def _init_blm_dispatch( self ) -> None:
+		all_chars : Set[str] = set()
+		for blm in self._block_level_matchers:
+			all_chars.update( blm.get_lead_chars() or '' )
+			
+		def applies( blm : BlockLevelMatcher, c : str ) -> bool:
+			lead_chars = blm.get_lead_chars()
+			return lead_chars is None or c in lead_chars
+			
+		self._blm_dispatch = {
+			c: [ blm for blm in self._block_level_matchers if applies( blm, c ) ]
+			for c in all_chars
+		}
+		self._blm_any = [ blm for blm in self._block_level_matchers if blm.get_lead_chars() is None ]
+		
+	def get_blm_candidates( self, lead_char : str ) -> Sequence[BlockLevelMatcher]:
+		"""
+			The matchers, in priority order, that may match a line starting with `lead_char`.
+		"""
+		return self._blm_dispatch.get( lead_char, self._blm_any )
+		
+	def get_plain_run_regex( self, end_char : str ) -> re.Pattern:
+		"""
+			Matches a run of characters which can only be plain text in a line ending with `end_char`.
+			None of them can start a feature, note, header, or escape. Text replacements are applied
+			to the run afterwards.
+		"""
+		regex = self._plain_run_regex.get( end_char )
+		if regex is None:
+			stops = { end_char, '\n', '\\', '^', ':' }
+			stops.update( tok[0] for tok in self._syntax_feature_map.keys() )
+			regex = re.compile( '[^' + ''.join( re.escape(c) for c in sorted(stops) ) + ']+' )
+			self._plain_run_regex[end_char] = regex
+		return regex
+	
+	
+class _LineFrame:
+	"""
+		The state of a line, or of an inline feature in it, being parsed by `TreeParser._parse_line`.
+	"""
+	__slots__ = ( 'bits', 'text', 'terminal', 'end_char', 'start_line', 'end_count', 'plain_run', 'feature' )
+	
+	def __init__( self, src : Source, terminal : Optional[str], feature : Optional[Node], grammar : Grammar ):
+		self.bits : List[Node] = []
+		self.text = ''
+		self.terminal = terminal
+		self.end_char = terminal if terminal is not None else '\n'
+		self.start_line = src.location
+		self.end_count = 0
+		self.plain_run = grammar.get_plain_run_regex( self.end_char )
+		# The inline node given the bits once the feature is closed, None for the line itself
+		self.feature = feature
+		
+	def end_text( self, src : Source ) -> None:
+		if len(self.text) == 0:
+			return
+		
+		n = Node(NodeType.text, src.location)
+		n.text = self.text
+		self.push_bit( n, src )
+		self.text = ''
+		
+	def push_bit( self, bit : Node, src : Source ) -> None:
+		bits = self.bits
+		if bit.type == NodeType.text and len(bits) > 0 and bits[-1].type == NodeType.text:
+			bits[-1].text += bit.text
+			bits[-1].end_offset = src.position
+		else:
+			bit.end_offset = src.position
+			bits.append(bit)
+			
+	def mark_header( self, src : Source ) -> None:
+		at = 0
+		while len(self.bits) > 0 and self.bits[at].class_ == '::':
+			at += 1
+			
+		collect = self.bits[at:]
+		self.bits = self.bits[:at]
+		header = Node(NodeType.inline, src.location)
+		header.class_ = '::'
+		header.add_subs( collect, trusted = True )
+		self.push_bit( header, src )
+	
+	
 
-		self._text_replace_map : Dict[str,str] = {}
-		self.add_text_replace( {
-			'--': '—',
-			'...': '…',
-			# a test to ensure this plugin support would work
-			':)': '☺',
-		})
-		
-		self._block_level_matchers = [
-			BLMAnnotation(),
-			BLMSeparator(),
-			BLMLine(),
-			BLMComment(),
-			BLMTag(),
-			BLMBlock(),
-			BLMFootnote(),
-			BLMRaw(),
-			BLMMatter(),
-		]
-		
-		self._init_features()
+
+class TreeParser:
+	"""
+		@param max_depth The deepest nesting of indented containers, and separately of inline
+			features within a line, that is parsed. Deeper nesting fails with `nesting-too-deep`.
+		@param block_memo If provided, files are parsed in runs of top-level blocks, and the
+			blocks of a run whose text was parsed before are copied from the memo
+	"""
+	def __init__(self, grammar : Optional[Grammar] = None, *, 
+		max_depth : int = 256,
+		block_memo : Optional[BlockMemo] = None,
+	):
+		self._grammar = grammar if grammar is not None else Grammar.default()
+		self._max_depth = max_depth
+		self._block_memo = block_memo
+		
+	@property
+	def grammar(self) -> Grammar:
+		return self._grammar
+		
+	@property
+	def block_memo(self) -> Optional[BlockMemo]:
+		return self._block_memo
 
 	def add_text_replace( self, reps : Dict[str,str] ) -> None:
-		for src, dst in reps.items():
-			assert src not in self._text_replace_map
-			self._text_replace_map[src] = dst
-			
-		self._trp_regex = None
-		
-	def _get_trp_regex(self) -> re.Pattern:
-		if self._trp_regex is None:
-			res = "|".join([ re.escape(k) for k in self._text_replace_map.keys() ])
-			self._trp_regex = re.compile( res )
-		return self._trp_regex
-		
-	def _init_features(self) -> None:
-		self._syntax_feature_map = {
-			'*': FeatureParse.open_close('*','*'),
-			'_': FeatureParse.open_close('_','_'),
-			'$`': FeatureParse.noescape_raw('$`','`'),
-			'`': FeatureParse.back_raw('`','`'),
-			'[': FeatureParse.open_close('[',']'),
-			'(': FeatureParse.back_raw('(',')'),
-			'{': FeatureParse.token('{','}'),
-		}
+		self._grammar = self._grammar.with_text_replace( reps )
 		
-		s = "|".join([re.escape(tok) for tok in self._syntax_feature_map.keys()])
-		self._syntax_feature = re.compile(s)
+	def add_block_level_matcher( self, blm : BlockLevelMatcher ) -> None:
+		"""
+			Adds a block-level matcher. It is tried after all the existing matchers, but before
+			falling back to a normal paragraph.
+		"""
+		self._grammar = self._grammar.with_block_level_matcher( blm )
 	
 	"""
 		Parses a file
@@ -298,36 +558,247 @@ class TreeParser:
 		@return A node representing the document
 	"""
 	def parse_file( self, filename : str ) -> Node:
+		return self._parse_source( Source.with_filename( filename ) )
+		
+	"""
+		Parses a file as `parse_file` does, splitting a large file into chunks at top-level blocks
+		and parsing the chunks in a process pool. The result is the same as that of `parse_file`.
+		Should any chunk fail to parse, the file is parsed serially, to report the error as
+		`parse_file` would.
+		
+		@param max_workers The number of processes to use, defaulting to the number of CPUs
+		@param chunk_size The minimum size of a chunk, smaller files are parsed serially
+	"""
+	def parse_file_parallel( self, filename : str, *, 
+		max_workers : Optional[int] = None, 
+		chunk_size : int = 1 << 16,
+	) -> Node:
 		in_source = Source.with_filename( filename )
-	
+		text = in_source.text
+		
+		workers = max_workers if max_workers is not None else ( os.cpu_count() or 1 )
+		# Several chunks per worker evens out the load when the blocks vary in size
+		splits = _split_top_level( text, max( chunk_size, len(text) // ( workers * 4 ) ) )
+		if workers < 2 or len(splits) == 0:
+			return self._parse_source( in_source )
+			
+		bounds = list( zip( [0] + splits, splits + [len(text)] ) )
+		try:
+			with concurrent.futures.ProcessPoolExecutor( max_workers = workers,
+				initializer = _init_chunk_worker, 
+				initargs = ( TreeParser( self._grammar, max_depth = self._max_depth ), text ) ) as executor:
+				results = list( executor.map( _parse_chunk, *zip( *bounds ) ) )
+		except Exception:
+			return self._parse_source( in_source )
+			
+		# A block may look past the end of its chunk, such as a header line taking the next line
+		# as its text. The chunk then ends past the split and the chunks don't fit together.
+		if any( stop != end for ( _, end ), ( _, _, stop ) in zip( bounds, results ) ):
+			return self._parse_source( in_source )
+			
+		root = Node(NodeType.container, in_source.location)
+		pending : List[Annotation] = []
+		for blocks, annotations, _ in results:
+			_rebase_chunk( blocks, annotations, in_source )
+			pending = _append_chunk( root, blocks, annotations, pending )
+			
+		root.end_offset = len(text)
+		return root
+		
+	"""
+		Parses a file without keeping the parse tree. The top-level blocks are given to 
+		`on_blocks`, in order, once each is complete.
+		
+		@param data The bytes of the file, if already read, else the file is read
+	"""
+	def parse_file_blocks( self, filename : str, on_blocks : Callable[[Sequence[Node]], None], *,
+		data : Optional[bytes] = None,
+	) -> None:
+		in_source = Source.with_filename( filename, data )
+		root = Node(NodeType.container, in_source.location)
+		self._parse_container( root, in_source, '', on_blocks = on_blocks )
+		on_blocks( root.iter_sub() )
+		
+	"""
+		Parses a file into a `FlatTree`. Each top-level block is moved into the flat tree once it
+		is complete, so only the `Node` objects of one block exist at a time.
+	"""
+	def parse_file_flat( self, filename : str ) -> FlatTree:
+		in_source = Source.with_filename( filename )
+		tree = FlatTree( in_source )
+		
+		root = Node(NodeType.container, in_source.location)
+		self._parse_container( root, in_source, '', on_blocks = tree.append_blocks )
+		tree.append_blocks( root.iter_sub() )
+		tree.set_end( in_source.position )
+		return tree
+		
+	def _parse_source( self, in_source : Source ) -> Node:
+		fingerprint = self._grammar.fingerprint
+		if self._block_memo is not None and fingerprint is not None:
+			try:
+				return self._parse_memoized( in_source, self._block_memo, fingerprint )
+			except ParseException:
+				# Parse it again in one piece, to report any error as that would
+				in_source.restore_location( SourceLocation( in_source, 0 ) )
+				
 		root = Node(NodeType.container, in_source.location)
 		self._parse_container( root, in_source, '' )
+		root.end_offset = in_source.position
+		return root
+		
+	def _parse_memoized( self, in_source : Source, memo : BlockMemo, fingerprint : bytes ) -> Node:
+		"""
+			Parses the text in runs between the splits of `_split_top_level`. A run is only taken
+			from, or added to, the memo if it starts at a split, and parsing it ends exactly at the
+			following split, thus the blocks depend on the text of the run alone. The last run, 
+			which no text follows, is always parsed, as a block there may extend if text is added.
+		"""
+		text = in_source.text
+		root = Node(NodeType.container, in_source.location)
+		pending : List[Annotation] = []
+		at_split = True
+		for end in _split_top_level( text, 0 ) + [len(text)]:
+			start = in_source.position
+			# A block parsed earlier may have extended past this split
+			if end <= start:
+				continue
+				
+			key = None
+			found = None
+			if at_split and end < len(text):
+				key = memo.get_key( fingerprint, '', text[start:end], max_depth = self._max_depth )
+				found = memo.get( key, in_source, start )
+				
+			if found is not None:
+				blocks, annotations = found
+				in_source.skip_to( end )
+			else:
+				run = Node(NodeType.container, in_source.location)
+				annotations = self._parse_container( run, in_source, '', stop_at = end )
+				blocks = list( run.iter_sub() )
+				at_split = in_source.position == end
+				if key is not None and at_split:
+					memo.put( key, blocks, annotations, start )
+					
+			pending = _append_chunk( root, blocks, annotations, pending )
+			
+		root.end_offset = in_source.position
 		return root
+		
+	"""
+		Parses the text resulting from replacing `old_text[start:end]` with `replace`.
+		
+		@param root The result of parsing `old_text`. Its nodes are reused in the new tree, and thus
+			should not be used after this call.
+		@return A node representing the document, as if the new text had been parsed in full
+	"""
+	def reparse( self, root : Node, old_text : str, start : int, end : int, replace : str ) -> Node:
+		assert root.type == NodeType.container
+		new_text = old_text[:start] + replace + old_text[end:]
+		shift = len(replace) - (end - start)
+		in_source = Source.with_text( new_text, SourceLocation( root.location.source, 0 ) )
+		
+		# Only the top-level blocks from the one ending at or after the edit are affected. One block
+		# before it is included as a block's parse may peek at the text just past its end.
+		blocks = root.iter_sub()
+		first = 0
+		while first < len(blocks) and blocks[first].end_offset < start:
+			first += 1
+		first = max( first - 1, 0 )
+		
+		# Parsing is back in sync with the old tree once it reaches, after the edit, the end of an old
+		# block. The old blocks following it are then reused.
+		old_ends = { blocks[at].end_offset: at for at in range( first, len(blocks) ) if blocks[at].end_offset >= end }
+		resync_at : Optional[int] = None
+		def resync( position : int ) -> bool:
+			nonlocal resync_at
+			if position < start + len(replace):
+				return False
+			resync_at = old_ends.get( position - shift )
+			return resync_at is not None
+		
+		new_root = Node(NodeType.container, in_source.location)
+		for block in blocks[:first]:
+			block.rebase( in_source, 0 )
+		new_root.add_subs( blocks[:first], trusted = True )
+		
+		in_source.skip_to( blocks[first-1].end_offset if first > 0 else 0 )
+		self._parse_container( new_root, in_source, '', resync = resync )
+		
+		if resync_at is not None:
+			for block in blocks[resync_at+1:]:
+				block.rebase( in_source, shift )
+			new_root.add_subs( blocks[resync_at+1:], trusted = True )
+			
+		new_root.end_offset = len(new_text)
+		return new_root
 	
 
-	def _parse_container( self, root, src, indent ):
-		builder = BlockLevelBuilder( src, self, indent )
+	def _parse_container( self, root, src, indent, *, 
+		resync : Optional[Callable[[int], bool]] = None,
+		stop_at : Optional[int] = None,
+		on_blocks : Optional[Callable[[Sequence[Node]], None]] = None,
+	) -> List[Annotation]:
+		"""
+			Parses blocks into `root`. Lines indented deeper than `indent` are parsed into a container
+			promoted from the block before them. The containers being parsed are kept on a stack,
+			the innermost last, rather than parsed recursively.
 			
-		while not src.is_at_end():
-			if src.match( _syntax_empty_line ) != None:
-				# TODO: It'd be preferable if the regex consumed the empty-line entirely
-				src.next_char()
+			@param resync Called at each top-level block, parsing stops if it returns True
+			@param stop_at No further blocks are started at or after this position
+			@param on_blocks Given the top-level blocks which are complete, instead of adding them
+				to `root`. The last block isn't complete until the next one starts, as following
+				indented lines are added to it.
+			@return the annotations following the last block, which aren't attached to any block
+		"""
+		stack = [ ( root, BlockLevelBuilder( src, self, indent ) ) ]
+			
+		while True:
+			container, builder = stack[-1]
+			end_container = src.is_at_end()
+			if not end_container and len(stack) == 1:
+				if resync is not None and len(builder._annotations) == 0 and resync( src.position ):
+					end_container = True
+				elif stop_at is not None and src.position >= stop_at:
+					end_container = True
+					
+			if not end_container:
+				if src.match( _syntax_empty_line ) != None:
+					# TODO: It'd be preferable if the regex consumed the empty-line entirely
+					src.next_char()
+					continue
+					
+				(match_indent, lead_space) = src.match_indent( builder._indent )
+				if not match_indent:
+					# TODO: add some strong rules about what's allowed here
+					if len(lead_space) < len(builder._indent):
+						end_container = True
+					else:
+						if len(lead_space) > len(builder._indent):
+							assert len(builder._blocks) > 0
+							if len(stack) >= self._max_depth:
+								raise src.fail( "nesting-too-deep", str(self._max_depth) )
+							child_container = builder._blocks[-1]
+							child_container.promote_to_container()
+							stack.append( ( child_container, BlockLevelBuilder( src, self, lead_space ) ) )
+						continue
+						
+			if end_container:
+				container.add_subs( builder._blocks, trusted = True )
+				stack.pop()
+				if len(stack) == 0:
+					return builder._annotations
+				container.end_offset = src.position
 				continue
 				
-			(match_indent, lead_space) = src.match_indent( indent )
-			if not match_indent:
-				# TODO: add some strong rules about what's allowed here
-				if len(lead_space) < len(indent):
-					break
-				if len(lead_space) > len(indent):
-					assert len(builder._blocks) > 0
-					child_container = builder._blocks[-1]
-					child_container.promote_to_container()
-					self._parse_container( child_container, src, lead_space )
-				continue
+			if on_blocks is not None and len(stack) == 1 and len(builder._blocks) > 1:
+				on_blocks( builder._blocks[:-1] )
+				del builder._blocks[:-1]
 
-			# Check all feature matches
-			for blm in self._block_level_matchers:
+			# Check the feature matches which may start with this character
+			lead_char = src.peek_char() if not src.is_at_end() else ''
+			for blm in self._grammar.get_blm_candidates( lead_char ):
 				match = src.match( blm.get_match_regex() )
 				if match != None:
 					blm.process( builder, match )
@@ -335,13 +806,10 @@ class TreeParser:
 			
 			#fallback to a normal paragraph
 			else:
-				para = self._parse_para(src, indent)
+				para = self._parse_para(src, builder._indent)
 				# drop empty paragraphs
 				if not para.sub_is_empty():
 					builder.append_block( para )
-
-
-		root.add_subs( builder._blocks )
 		
 
 	#TODO: unused?
@@ -356,128 +824,113 @@ class TreeParser:
 		sub.extend( node.iter_sub() )
 		
 		close_bit = Node( NodeType.text, node.location )
-		close_bit.text = self._syntax_feature_map[node.class_]
+		close_bit.text = self._grammar.feature_map[node.class_]
 		sub.append( close_bit )
 		return sub
 		
 		
 	def _parse_line( self, src : Source, terminal : Optional[str] = None ) -> Sequence[Node]:
-		bits : List[Node] = []
-		text = ''
-		end_char = terminal if terminal is not None else '\n'
-		start_line = src.location
+		"""
+			Parses a line up to `terminal`, or the end of the line. The inline features nested in the
+			line are kept on a stack of frames, the innermost last, rather than parsed recursively.
+		"""
+		frame = _LineFrame( src, terminal, None, self._grammar )
+		frames = [ frame ]
 		
-		def end_text():
-			nonlocal text
-			if len(text) == 0:
-				return
-			
-			n = Node(NodeType.text, src.location)
-			n.text = text
-			push_bit(n)
-			text = ''
-			
-		def push_bits(bits):
-			for bit in bits:
-				push_bit(bit)
-				
-		def push_bit(bit):
-			if bit.type == NodeType.text and len(bits) > 0 and bits[-1].type == NodeType.text:
-				bits[-1].text += bit.text
-			else:
-				bits.append(bit)
-				
-		def mark_header():
-			nonlocal bits
-			at = 0
-			while len(bits) > 0 and bits[at].class_ == '::':
-				at += 1
-				
-			collect = bits[at:]
-			bits = bits[:at]
-			header = Node(NodeType.inline, src.location)
-			header.class_ = '::'
-			header.add_subs( collect )
-			push_bit( header )
-			
-		def end_bits():
-			pass
-				
-		has_end_char = False
-		end_count = 0
-		while not src.is_at_end():
-			c = src.peek_char()
-			if c == end_char:
-				has_end_char = True
-				_ = src.next_char()
-				break
-				
-			if c == '\n':
-				if len(text) == 0:
-					raise src.fail_from(start_line, "trailing-inline-feature", end_char)
-				if end_count != 0:
-					raise src.fail_from(start_line, "break-inline-feature", end_char )
+		while True:
+			has_end_char = False
+			while not src.is_at_end():
+				run_match = src.peek_match( frame.plain_run )
+				if run_match is not None:
+					run_text, run_end = self._grammar.text_replace.replace_run( src.text, run_match.start(), run_match.end() )
+					src.skip_to( run_end )
+					frame.text += run_text
+					frame.end_count = 0
+					continue
 					
-				text += " "
-				end_count+=1
-				continue
-				
-			end_count = 0
-			
-			if c == '\\':
-				_ = src.next_char()
-				text += src.next_char()
-				continue
-				
-			note_match = src.match( _syntax_inline_note )
-			if note_match is not None:
-				note_name = note_match.group(1)
-				end_text()
-				note = Node( NodeType.inline, src.location )
-				note.class_ = '^'
-				note.text = note_name
-				push_bit( note )
-				continue
-				
-			header_match = src.match( _syntax_inline_header )
-			if header_match is not None:
-				end_text()
-				mark_header()
-				continue
-				
-			feature_match = src.match( self._syntax_feature )
-			if feature_match is not None:
-				feature_class = feature_match.group(0)
-				end_text()
-				
-				feature_parse = self._syntax_feature_map[feature_class]
+				c = src.peek_char()
+				if c == frame.end_char:
+					has_end_char = True
+					_ = src.next_char()
+					break
+					
+				if c == '\n':
+					if len(frame.text) == 0:
+						raise src.fail_from(frame.start_line, "trailing-inline-feature", frame.end_char)
+					if frame.end_count != 0:
+						raise src.fail_from(frame.start_line, "break-inline-feature", frame.end_char )
+						
+					frame.text += " "
+					frame.end_count+=1
+					continue
+					
+				frame.end_count = 0
 				
-				feature = Node( NodeType.inline, src.location )
-				feature.class_ = feature_class
-				if feature_parse.is_back_raw:
-					feature_text = self._parse_raw_escape_to( src, feature_parse.close_char )
-					feature.text = feature_text
-				elif feature_parse.is_noescape_raw:
-					feature_text = self._parse_raw_escape_to( src, feature_parse.close_char, escape=None )
-					feature.text = feature_text
-				elif feature_parse.is_token:
-					feature_args = self._parse_args( src, feature_parse.close_char )
-					feature.add_args( feature_args )
-				else:
-					feature_line = self._parse_line( src, feature_parse.close_char )
-					feature.add_subs( feature_line )
-				push_bit( feature )
-				continue
+				if c == '\\':
+					_ = src.next_char()
+					frame.text += src.next_char()
+					continue
+					
+				note_match = src.match( _syntax_inline_note )
+				if note_match is not None:
+					note_name = note_match.group(1)
+					frame.end_text( src )
+					note = Node( NodeType.inline, src.location )
+					note.class_ = '^'
+					note.text = note_name
+					frame.push_bit( note, src )
+					continue
+					
+				header_match = src.match( _syntax_inline_header )
+				if header_match is not None:
+					frame.end_text( src )
+					frame.mark_header( src )
+					continue
+					
+				feature_match = src.match( self._grammar.feature_regex )
+				if feature_match is not None:
+					feature_class = feature_match.group(0)
+					frame.end_text( src )
+					
+					feature_parse = self._grammar.feature_map[feature_class]
+					
+					feature = Node( NodeType.inline, src.location )
+					feature.class_ = feature_class
+					if feature_parse.is_back_raw:
+						feature_text = self._parse_raw_escape_to( src, feature_parse.close_char )
+						feature.text = feature_text
+					elif feature_parse.is_noescape_raw:
+						feature_text = self._parse_raw_escape_to( src, feature_parse.close_char, escape=None )
+						feature.text = feature_text
+					elif feature_parse.is_token:
+						feature_args = self._parse_args( src, feature_parse.close_char )
+						feature.add_args( feature_args )
+					else:
+						if len(frames) >= self._max_depth:
+							raise src.fail( "nesting-too-deep", str(self._max_depth) )
+						frame = _LineFrame( src, feature_parse.close_char, feature, self._grammar )
+						frames.append( frame )
+						continue
+					frame.push_bit( feature, src )
+					continue
+					
+					
+				frame.text += self._parse_char( src )
 				
+			# The innermost feature, or the line itself, has ended
+			if frame.terminal is not None and not has_end_char:
+				raise src.fail_from(frame.start_line, "unterminated-line-feature", frame.end_char )
 				
-			text += self._parse_char( src )
+			frame.end_text( src )
+			frames.pop()
+			if len(frames) == 0:
+				return frame.bits
 				
-		if terminal is not None and not has_end_char:
-			raise src.fail_from(start_line, "unterminated-line-feature", end_char )
-			
-		end_text()
-		end_bits()
-		return bits
+			closed = frame.feature
+			assert closed is not None
+			closed.add_subs( frame.bits, trusted = True )
+			frame = frames[-1]
+			frame.push_bit( closed, src )
 
 	def _parse_raw_escape_to( self, src, close_char, escape = '\\' ):
 		start_line = src.location
@@ -507,9 +960,10 @@ class TreeParser:
 		Parse the next textual character. This should be used in any place text is being constructed.
 	"""
 	def _parse_char( self, src : Source ) -> str:
-		m = src.match( self._get_trp_regex() )
-		if m is not None:
-			return self._text_replace_map[m.group(0)]
+		found = self._grammar.text_replace.match_at( src.text, src.position )
+		if found is not None:
+			src.skip_to( found[0] )
+			return found[1]
 		return src.next_char()
 		
 	def _parse_para( self, src : Source, indent : str ) -> Node:
@@ -534,9 +988,10 @@ class TreeParser:
 				last = para.sub_last()
 				if last != None and last.type == NodeType.text:
 					last.text = last.text + ' ' + line[0].text
+					last.end_offset = line[0].end_offset
 					line = line[1:]
 			
-			para.add_subs( line )
+			para.add_subs( line, trusted = True )
 			
 		return para
 		
@@ -564,4 +1019,85 @@ class TreeParser:
 		
 		return result
 	
-__all__ = [ 'TreeParser', 'Node', 'NodeType' ]
+
+_syntax_split_marker = re.compile( r'^(?:[\p{Space_Separator}\t]*(```)|(\+\+\+)|(?<=\n\n)(?=\S))', re.MULTILINE )
+
+def _split_top_level( text : str, chunk_size : int ) -> List[int]:
+	"""
+		Offsets at which `text` can be split into chunks, of at least `chunk_size`, that parse
+		independently. Splits are made before a line without indent that follows an empty line, 
+		outside of raw blocks and matter.
+	"""
+	splits : List[int] = []
+	last = 0
+	in_raw = False
+	in_matter = False
+	for match in _syntax_split_marker.finditer( text ):
+		if in_raw:
+			# The closing fence is never indented
+			if match.group(1) is not None and match.start(1) == match.start():
+				in_raw = False
+		elif in_matter:
+			if match.group(2) is not None and BLMMatter.pattern_end.match( text, match.start() ) is not None:
+				in_matter = False
+		elif match.group(1) is not None:
+			in_raw = True
+		elif match.group(2) is not None:
+			in_matter = True
+		elif match.start() - last >= chunk_size:
+			splits.append( match.start() )
+			last = match.start()
+			
+	return splits
+	
+	
+# The parser and full text of a worker process in `parse_file_parallel`
+_chunk_parser : Optional[TreeParser] = None
+_chunk_text = ''
+
+def _init_chunk_worker( parser : TreeParser, text : str ) -> None:
+	global _chunk_parser, _chunk_text
+	_chunk_parser = parser
+	_chunk_text = text
+	
+def _parse_chunk( start : int, end : int ) -> Tuple[List[Node], List[Annotation], int]:
+	"""
+		Parses the top-level blocks starting in text[start:end]. The whole text is parsed from, so
+		that offsets are those of the file, and a block may extend past `end`.
+		
+		@return the blocks, the annotations following the last of them, and where parsing stopped
+	"""
+	assert _chunk_parser is not None
+	src = Source.with_text( _chunk_text )
+	src.skip_to( start )
+	root = Node(NodeType.container, src.location)
+	annotations = _chunk_parser._parse_container( root, src, '', stop_at = end )
+	
+	# Detach the nodes from the source, else the whole text is sent back with each chunk
+	_rebase_chunk( root.iter_sub(), annotations, Source.with_text( '' ) )
+	return root.iter_sub(), annotations, src.position
+	
+def _append_chunk( root : Node, blocks : Sequence[Node], annotations : List[Annotation], 
+	pending : List[Annotation] ) -> List[Annotation]:
+	"""
+		Adds the blocks parsed from a chunk of the text to `root`. Annotations at the end of a
+		chunk belong to the first block of a following chunk.
+		
+		@param pending The annotations left after the blocks of the previous chunks
+		@return the annotations left after the blocks of this chunk
+	"""
+	if len(blocks) == 0:
+		return pending + annotations
+	blocks[0].prepend_annotations( pending )
+	root.add_subs( blocks, trusted = True )
+	return annotations
+	
+def _rebase_chunk( blocks : List[Node], annotations : List[Annotation], source : Source ) -> None:
+	for block in blocks:
+		block.rebase( source, 0 )
+	for anno in annotations:
+		if anno.node is not None:
+			anno.node.rebase( source, 0 )
+	
+	
+__all__ = [ 'TreeParser', 'Grammar', 'Node', 'NodeType' ]
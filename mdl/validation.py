@@ -0,0 +1,72 @@
+# Structural checks made while building parse and document trees
+__all__ = [ 'ValidationLevel', 'set_validation_level', 'get_validation_level' ]
+
+from typing import *
+from enum import Enum
+
+
+class ValidationLevel(Enum):
+	# Children are added without checks, for trusted output such as that of the parser
+	off = 1
+	# One in every `_sample_stride` children added is checked
+	sampled = 2
+	# Every child added is checked
+	full = 3
+
+
+# The level for children added by any code
+_level = ValidationLevel.full
+# The level for children added as trusted, by the parser and the document conversion
+_trusted_level = ValidationLevel.sampled
+_sample_stride = 16
+# Children added since the last sampled check
+_sample_count = 0
+
+def set_validation_level( level : ValidationLevel, *, trusted : bool = False ) -> None:
+	"""
+		@param trusted Sets the level for children added as trusted, rather than the others
+	"""
+	global _level, _trusted_level
+	if trusted:
+		_trusted_level = level
+	else:
+		_level = level
+
+def get_validation_level( *, trusted : bool = False ) -> ValidationLevel:
+	return _trusted_level if trusted else _level
+
+
+def should_validate( trusted : bool = False ) -> bool:
+	"""
+		Whether a single child being added is to be checked.
+	"""
+	global _sample_count
+	level = _trusted_level if trusted else _level
+	if level is ValidationLevel.full:
+		return True
+	if level is ValidationLevel.off:
+		return False
+
+	_sample_count += 1
+	if _sample_count < _sample_stride:
+		return False
+	_sample_count = 0
+	return True
+
+
+T = TypeVar('T')
+
+def select_for_validation( subs : Sequence[T], trusted : bool = False ) -> Sequence[T]:
+	"""
+		Those of children being added in bulk that are to be checked.
+	"""
+	global _sample_count
+	level = _trusted_level if trusted else _level
+	if level is ValidationLevel.full:
+		return subs
+	if level is ValidationLevel.off:
+		return ()
+
+	first = _sample_stride - 1 - _sample_count
+	_sample_count = ( _sample_count + len(subs) ) % _sample_stride
+	return subs[first::_sample_stride]
@@ -2,8 +2,8 @@
 	Test driver for document tests.
 """
 from typing import Callable, Any
-import os, sys
-from mdl import tree_parser, parse_to_doc, format_html, document, parse_tree_dump, structure, format_mdl
+import io, os, sys, tempfile
+from mdl import tree_parser, parse_to_doc, format_html, document, parse_tree_dump, structure, format_mdl, validation, doc_cache, block_memo, doc_tree, tree_formatter, format_markdown
 import mdl
 from dataclasses import dataclass
 from shelljob import fs #type: ignore
@@ -22,6 +22,136 @@ def status(text, okay):
 		bad_count += 1
 	print( passed(text) if okay else failed(text), end=' ' )
 	
+class _VisitRecorder:
+	def __init__( self ) -> None:
+		self.events : list[tuple[str, doc_tree.Node]] = []
+		
+	def enter( self, node : doc_tree.Node ) -> bool:
+		self.events.append( ( 'enter', node ) )
+		return True
+		
+	def exit( self, node : doc_tree.Node ) -> None:
+		self.events.append( ( 'exit', node ) )
+		
+		
+class _TextCountWriter(mdl.HtmlWriter):
+	def __init__( self ) -> None:
+		super().__init__()
+		self.text_count = 0
+		
+	def _write_text( self, node : doc_tree.Text ) -> bool:
+		self.text_count += 1
+		return super()._write_text( node )
+		
+		
+# Deletes "b" and "c", inserts "x" before "d", and splices "e" into "e1" and a bold "f"
+class _TransformRecorder(doc_tree.TransformCallback):
+	def __init__( self ) -> None:
+		self.events : list[tuple[str, str]] = []
+		
+	def enter( self, node : doc_tree.Node ) -> bool:
+		self.events.append( ( 'enter', _node_name( node ) ) )
+		return True
+		
+	def exit( self, node : doc_tree.Node ) -> None:
+		self.events.append( ( 'exit', _node_name( node ) ) )
+		
+	def transform( self, node : doc_tree.Node ) -> tuple[doc_tree.TransformType, doc_tree.Node | list[doc_tree.Node]]:
+		name = _node_name( node )
+		self.events.append( ( 'transform', name ) )
+		if name in ( 'b', 'c' ):
+			return ( doc_tree.TransformType.delete, node )
+		if name == 'd':
+			return ( doc_tree.TransformType.insert, [ doc_tree.Text( 'x' ) ] )
+		if name == 'e':
+			bold = doc_tree.Inline( doc_tree.feature_bold )
+			bold.add_sub( doc_tree.Text( 'f' ) )
+			return ( doc_tree.TransformType.splice, [ doc_tree.Text( 'e1' ), bold ] )
+		return ( doc_tree.TransformType.retain, node )
+		
+def _node_name( node : doc_tree.Node ) -> str:
+	return node.text if isinstance( node, doc_tree.Text ) else type(node).__name__
+	
+def _parse_offsets( node : tree_parser.Node ) -> list[tuple[int, int]]:
+	offsets = []
+	stack = [ node ]
+	while len(stack) > 0:
+		node = stack.pop()
+		offsets.append( ( node.location.offset, node.end_offset ) )
+		stack.extend( anno.node for anno in node.iter_annotations() if anno.node is not None )
+		stack.extend( reversed( node.iter_sub() ) )
+	return offsets
+	
+_reparse_text = """# Heading
+
+First paragraph with *bold* text.
+
+Second paragraph
+continues here.
+
+- item one
+	child of one
+- item two
+
+Last paragraph.
+"""
+
+# The edits, as `start`, `end` and replacement, to check reparsing against a full parse
+_reparse_edits = [
+	# Insert a paragraph
+	( _reparse_text.index( 'Second' ), _reparse_text.index( 'Second' ), 'Inserted paragraph.\n\n' ),
+	# Delete a paragraph
+	( _reparse_text.index( 'Second' ), _reparse_text.index( '- item one' ), '' ),
+	# Remove a blank line, merging the paragraphs and moving where the later blocks start
+	( _reparse_text.index( 'text.' ) + 6, _reparse_text.index( 'Second' ), '' ),
+	# Start a list item, changing the type of a later block
+	( _reparse_text.index( 'Last' ), _reparse_text.index( 'Last' ), '- ' ),
+	# Edit inside an indented child
+	( _reparse_text.index( 'child' ), _reparse_text.index( ' of one' ), 'nested kid' ),
+]
+
+def test_reparse() -> None:
+	print( 'reparse', end=' ' )
+	tp = tree_parser.TreeParser()
+	okay = True
+	with tempfile.TemporaryDirectory() as temp_dir:
+		old_name = os.path.join( temp_dir, 'old.mdl' )
+		new_name = os.path.join( temp_dir, 'new.mdl' )
+		with open( old_name, 'w', encoding = 'utf-8' ) as out_file:
+			out_file.write( _reparse_text )
+			
+		for start, end, replace in _reparse_edits:
+			with open( new_name, 'w', encoding = 'utf-8' ) as out_file:
+				out_file.write( _reparse_text[:start] + replace + _reparse_text[end:] )
+			full = tp.parse_file( new_name )
+			reparsed = tp.reparse( tp.parse_file( old_name ), _reparse_text, start, end, replace )
+			okay = okay and parse_tree_dump.get_dump( reparsed ) == parse_tree_dump.get_dump( full ) \
+				and _parse_offsets( reparsed ) == _parse_offsets( full )
+	status( 'Edits', okay )
+	print()
+	
+	
+def test_transform() -> None:
+	print( 'transform', end=' ' )
+	para = doc_tree.Paragraph( [ doc_tree.Text( name ) for name in 'abcde' ] )
+	recorder = _TransformRecorder()
+	para.transform( recorder )
+	
+	status( 'Children', [ _node_name( node ) for node in para.iter_sub() ] == [ 'a', 'x', 'd', 'e1', 'Inline' ] )
+	status( 'Events', recorder.events == [
+		( 'enter', 'Paragraph' ),
+		( 'transform', 'a' ), ( 'enter', 'a' ), ( 'exit', 'a' ),
+		( 'transform', 'b' ),
+		( 'transform', 'c' ),
+		( 'transform', 'd' ), ( 'enter', 'x' ), ( 'exit', 'x' ), ( 'enter', 'd' ), ( 'exit', 'd' ),
+		( 'transform', 'e' ), ( 'enter', 'e1' ), ( 'exit', 'e1' ), ( 'enter', 'Inline' ),
+			( 'transform', 'f' ), ( 'enter', 'f' ), ( 'exit', 'f' ),
+		( 'exit', 'Inline' ),
+		( 'exit', 'Paragraph' ),
+	] )
+	print()
+	
+	
 def test_mdl( fname: str ) -> None:
 	print( fname, end= ' ' )
 	base = os.path.splitext( fname )[0]
@@ -37,6 +167,26 @@ def test_mdl( fname: str ) -> None:
 		
 		status( 'Parse', parse_dump == check_dump )
 		
+		# Reparsing an edit that leaves the text unchanged must reproduce the same tree
+		with open( fname, 'r', encoding = 'utf-8' ) as in_file:
+			text = in_file.read()
+		mid = len(text) // 2
+		reparsed = tp.reparse( tp.parse_file( fname ), text, mid, mid + 1, text[mid:mid+1] )
+		status( 'Reparse', parse_tree_dump.get_dump( reparsed ) == check_dump )
+		
+		# Split at every possible block to exercise the stitching of chunks
+		parallel = tp.parse_file_parallel( fname, max_workers = 2, chunk_size = 1 )
+		status( 'Parallel', parse_tree_dump.get_dump( parallel ) == check_dump )
+		
+		flat = tp.parse_file_flat( fname )
+		status( 'Flat', parse_tree_dump.get_dump( flat.root ) == check_dump )
+		
+		# The second parse takes every block before the last split from the memo
+		memo_tp = tree_parser.TreeParser( block_memo = block_memo.BlockMemo() )
+		_ = memo_tp.parse_file( fname )
+		memoized = memo_tp.parse_file( fname )
+		status( 'Memo', parse_tree_dump.get_dump( memoized ) == check_dump )
+		
 	doc_name = base + '.doc'
 	if os.path.exists( doc_name ):
 		doc = mdl.load_document( fname )
@@ -46,6 +196,41 @@ def test_mdl( fname: str ) -> None:
 			
 		status( 'Doc', doc_dump == check_dump )
 		
+		# The document is loaded block by block, check it matches converting the whole parse tree
+		two_pass = document._load_document_two_pass( fname )
+		status( 'Two-pass', document.dump_document( two_pass ) == check_dump )
+		
+		# Converting the flat parse tree gives the same document, when there are no sub-documents
+		if len(doc.sub) == 0:
+			flat_doc = document.Document()
+			flat_doc.set_meta( doc.meta )
+			flat_doc.set_root( parse_to_doc.convert( tree_parser.TreeParser().parse_file_flat( fname ) ) )
+			status( 'Flat-Doc', document.dump_document( flat_doc ) == check_dump )
+		
+		if doc.root is not None:
+			visited = _VisitRecorder()
+			doc.root.visit( visited )
+			walked = [ ( event.name, node ) for event, node in doc_tree.walk( doc.root ) ]
+			status( 'Walk', walked == visited.events )
+			
+			blocks = [ node for event, node in walked if event == 'enter' and isinstance( node, doc_tree.BlockNode ) ]
+			indexed = list( doc.root.find_all( doc_tree.BlockNode ) ) == blocks
+			
+			# Changing another tree keeps the index, adding to this one replaces it
+			index = doc.root._get_index()
+			doc_tree.Paragraph().add_sub( doc_tree.Text( 'other' ) )
+			kept = doc.root._get_index() is index
+			added = doc_tree.Paragraph()
+			doc.root.add_sub( added )
+			status( 'Index', indexed and kept and doc.root.find_all( doc_tree.Paragraph )[-1] is added )
+		
+		# The second load comes from the cache
+		with tempfile.TemporaryDirectory() as cache_dir:
+			cache = doc_cache.DocumentCache( cache_dir )
+			_ = mdl.load_document( fname, cache = cache )
+			cached = mdl.load_document( fname, cache = cache )
+		status( 'Cache', document.dump_document( cached ) == check_dump )
+		
 	directions = check_directions( fname, base, parse_file=tp.parse_file )
 	
 	if not directions.skip_doc:
@@ -62,9 +247,34 @@ def test_mdl( fname: str ) -> None:
 		
 		status( 'HTML', html == check_html )
 		
+		writer_types = [ mdl.HtmlWriter, format_mdl.MdlWriter, format_markdown.MarkdownWriter ]
+		status( 'Stream', all( _stream_matches( writer_type, doc ) for writer_type in writer_types ) )
+		
+		# A writer's handlers are the methods of its own class, including overrides
+		counter = _TextCountWriter()
+		counted = counter.render( doc )
+		has_text = doc.root is not None and doc.root.any( doc_tree.Text )
+		status( 'Override', counted == html and ( counter.text_count > 0 ) == has_text )
+		
 	print()
 	
 	
+def _stream_matches( writer_type : Callable[[], Any], doc : document.Document ) -> bool:
+	text = writer_type().render( doc )
+	okay = True
+	# Flushing after every context as well, as a large document would
+	flush_chunks = tree_formatter.TreeFormatter._flush_chunks
+	for flush_at in [ flush_chunks, 1 ]:
+		tree_formatter.TreeFormatter._flush_chunks = flush_at
+		try:
+			stream = io.StringIO()
+			writer_type().render_to( doc, stream )
+		finally:
+			tree_formatter.TreeFormatter._flush_chunks = flush_chunks
+		okay = okay and stream.getvalue() == text
+	return okay
+	
+	
 def test_rewrite( fname: str ) -> None:
 	orig_doc = mdl.load_document( fname )
 	orig_dump = document.dump_document( orig_doc )
@@ -153,6 +363,12 @@ def test_mcl( fname: str ) -> None:
 	print()
 
 def main() -> None:
+	# Other children are fully checked by default, check those from the parser fully as well
+	validation.set_validation_level( validation.ValidationLevel.full, trusted = True )
+	
+	test_reparse()
+	test_transform()
+	
 	for fname in fs.find( 'test/docs', name_regex = r".*\.mdl" ):
 		test_mdl( fname )
 	for fname in fs.find( 'test/structures', name_regex = r".*\.mcl" ):